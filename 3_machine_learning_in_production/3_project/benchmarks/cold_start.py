@@ -0,0 +1,85 @@
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVE_DIR = os.path.join(PROJECT_DIR, 'serve')
+sys.path.insert(0, SERVE_DIR)
+
+from model import LSTMClassifier
+from artifact import ARTIFACT_NAME, save_artifact
+
+# Runs in a fresh interpreter, so every measurement is a real cold start of a worker
+_LOAD_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {serve_dir!r})
+start = time.perf_counter()
+from predict import model_fn
+imported = time.perf_counter()
+model = model_fn({model_dir!r})
+model.word_dict.get('film')
+loaded = time.perf_counter()
+print(imported - start, loaded - imported)
+'''
+
+
+def write_model_dir(model_dir, embedding_dim, hidden_dim, vocab_size, single_artifact, word_dict=None):
+    """
+    Write a randomly initialized model in the three-file layout, optionally plus the artifact.
+    Without a word_dict, a made-up vocabulary of vocab_size words is stored.
+    """
+    model = LSTMClassifier(embedding_dim, hidden_dim, vocab_size)
+    model_info = {'embedding_dim': embedding_dim, 'hidden_dim': hidden_dim, 'vocab_size': vocab_size}
+    if word_dict is None:
+        word_dict = {'word{}'.format(idx): idx for idx in range(2, vocab_size)}
+
+    with open(os.path.join(model_dir, 'model_info.pth'), 'wb') as f:
+        torch.save(model_info, f)
+    with open(os.path.join(model_dir, 'word_dict.pkl'), 'wb') as f:
+        pickle.dump(word_dict, f)
+    with open(os.path.join(model_dir, 'model.pth'), 'wb') as f:
+        torch.save(model.state_dict(), f)
+
+    if single_artifact:
+        save_artifact(os.path.join(model_dir, ARTIFACT_NAME), model_info, model.state_dict(), word_dict)
+
+
+def cold_start(model_dir, runs):
+    """Return the median import and model_fn times in seconds over `runs` fresh processes."""
+    script = _LOAD_SCRIPT.format(serve_dir=SERVE_DIR, model_dir=model_dir)
+    imports, loads = [], []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script], stderr=subprocess.DEVNULL)
+        import_time, load_time = output.decode('utf-8').split('\n')[-2].split()
+        imports.append(float(import_time))
+        loads.append(float(load_time))
+    return float(np.median(imports)), float(np.median(loads))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare model_fn cold start for the three-file layout '
+                                                 'and the single memory-mapped artifact.')
+    parser.add_argument('--embedding_dim', type=int, default=32, metavar='N')
+    parser.add_argument('--hidden_dim', type=int, default=200, metavar='N')
+    parser.add_argument('--vocab_size', type=int, default=5000, metavar='N')
+    parser.add_argument('--runs', type=int, default=5, metavar='N',
+                        help='number of fresh processes per layout, the median is reported (default: 5)')
+    args = parser.parse_args()
+
+    results = {}
+    for name, single_artifact in [('three files', False), ('single artifact', True)]:
+        with tempfile.TemporaryDirectory() as model_dir:
+            torch.manual_seed(0)
+            write_model_dir(model_dir, args.embedding_dim, args.hidden_dim, args.vocab_size, single_artifact)
+            results[name] = cold_start(model_dir, args.runs)
+
+    baseline = results['three files'][1]
+    for name, (import_time, load_time) in results.items():
+        print('{:<16} model_fn {:7.1f} ms {:5.1f}x   (import {:7.1f} ms)'.format(
+            name, load_time * 1000, baseline / load_time, import_time * 1000))
@@ -0,0 +1,61 @@
+import argparse
+import os
+import sys
+
+import nltk
+from nltk.corpus import stopwords
+from nltk.stem.porter import *
+
+import re
+from bs4 import BeautifulSoup
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'serve'))
+
+from review_files import read_labelled_reviews, run_times
+from utils import ReviewPreprocessor
+
+
+def review_to_words_reference(review):
+    """The original per-call implementation, kept here as the baseline to compare against."""
+    nltk.download("stopwords", quiet=True)
+    stemmer = PorterStemmer()
+    
+    text = BeautifulSoup(review, "html.parser").get_text() # Remove HTML tags
+    text = re.sub(r"[^a-zA-Z0-9]", " ", text.lower()) # Convert to lower case
+    words = text.split() # Split string into words
+    words = [w for w in words if w not in stopwords.words("english")] # Remove stopwords
+    words = [PorterStemmer().stem(w) for w in words] # stem
+    
+    return words
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare review_to_words against ReviewPreprocessor.')
+    parser.add_argument('--data-dirs', nargs='+',
+                        default=[os.path.join(PROJECT_DIR, 'short_test'), os.path.join(PROJECT_DIR, 'long_test')],
+                        help='directories with pos/neg review folders (default: short_test long_test)')
+    parser.add_argument('--repeat', type=int, default=3, metavar='N',
+                        help='number of timed runs, the fastest one is reported (default: 3)')
+    args = parser.parse_args()
+
+    reviews, _ = read_labelled_reviews(args.data_dirs)
+    preprocessor = ReviewPreprocessor()
+
+    # Both implementations have to agree on every single token
+    expected = [review_to_words_reference(review) for review in reviews]
+    assert preprocessor.transform(reviews) == expected, 'ReviewPreprocessor output differs from review_to_words'
+
+    reference_time = min(run_times(lambda: [review_to_words_reference(review) for review in reviews], args.repeat))
+    # A fresh instance per run, so the stem cache starts out cold
+    cold_time = min(run_times(lambda: ReviewPreprocessor().transform(reviews), args.repeat))
+    warm_time = min(run_times(lambda: preprocessor.transform(reviews), args.repeat))
+
+    words = sum(len(tokens) for tokens in expected)
+    print('{} reviews, {} words'.format(len(reviews), words))
+    for name, seconds in [('review_to_words', reference_time),
+                          ('ReviewPreprocessor (cold)', cold_time),
+                          ('ReviewPreprocessor (warm)', warm_time)]:
+        print('{:<26} {:8.1f} ms {:10.0f} reviews/s {:6.1f}x'.format(
+            name, seconds * 1000, len(reviews) / seconds, reference_time / seconds))
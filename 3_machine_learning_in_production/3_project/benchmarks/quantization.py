@@ -0,0 +1,93 @@
+import argparse
+import copy
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'serve'))
+
+from predict import model_fn, quantize_model, encode_reviews, predict_rows
+from review_files import read_labelled_reviews
+
+
+def model_size(model):
+    """Size of the serialized state_dict in bytes, which is what every worker keeps in memory."""
+    stream = io.BytesIO()
+    torch.save(model.state_dict(), stream)
+    return stream.tell()
+
+
+def score(model, data, batch_size):
+    """
+    Return the probabilities for the encoded reviews plus the median single-review latency and
+    the throughput when scoring in batches of batch_size.
+    """
+    latencies = []
+    for row in data:
+        start = time.perf_counter()
+        predict_rows(row[None, :], model)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    probabilities = np.concatenate([predict_rows(data[idx:idx + batch_size], model)
+                                    for idx in range(0, len(data), batch_size)])
+    throughput = len(data) / (time.perf_counter() - start)
+
+    return probabilities, np.median(latencies), throughput
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the float and the int8 quantized sentiment model.')
+    parser.add_argument('--model-dir', type=str, required=True,
+                        help='directory with a trained model (model.bin or the three model files)')
+    parser.add_argument('--data-dirs', nargs='+',
+                        default=[os.path.join(PROJECT_DIR, 'short_test'), os.path.join(PROJECT_DIR, 'long_test')],
+                        help='directories with pos/neg review folders (default: short_test long_test)')
+    parser.add_argument('--batch-size', type=int, default=64, metavar='N',
+                        help='batch size for the throughput measurement (default: 64)')
+    parser.add_argument('--max-accuracy-drop', type=float, default=None, metavar='X',
+                        help='exit with an error if quantization costs more accuracy than this, e.g. 0.01')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+
+    float_model = model_fn(args.model_dir)
+    quantized_model = quantize_model(copy.deepcopy(float_model))
+
+    print('{:<12} {:>8} {:>10} {:>10} {:>8} {:>12} {:>12} {:>10}'.format(
+        'data', 'reviews', 'float acc', 'int8 acc', 'delta', 'float ms', 'int8 ms', 'agree'))
+
+    worst_drop = 0.0
+    for data_dir in args.data_dirs:
+        reviews, labels = read_labelled_reviews([data_dir])
+        data = encode_reviews(reviews, float_model)
+
+        float_prob, float_latency, float_throughput = score(float_model, data, args.batch_size)
+        int8_prob, int8_latency, int8_throughput = score(quantized_model, data, args.batch_size)
+
+        float_accuracy = np.mean(float_prob.round() == labels)
+        int8_accuracy = np.mean(int8_prob.round() == labels)
+        agreement = np.mean(float_prob.round() == int8_prob.round())
+        worst_drop = max(worst_drop, float_accuracy - int8_accuracy)
+
+        print('{:<12} {:>8} {:>10.4f} {:>10.4f} {:>+8.4f} {:>12.2f} {:>12.2f} {:>10.4f}'.format(
+            os.path.basename(os.path.normpath(data_dir)), len(reviews), float_accuracy, int8_accuracy,
+            int8_accuracy - float_accuracy, float_latency * 1000, int8_latency * 1000, agreement))
+        print('{:<12} batch throughput: float {:.0f} reviews/s, int8 {:.0f} reviews/s, '
+              'max |p_float - p_int8| = {:.4f}'.format(
+                  '', float_throughput, int8_throughput, np.abs(float_prob - int8_prob).max()))
+
+    float_size = model_size(float_model)
+    int8_size = model_size(quantized_model)
+    print('model size: float {:.2f} MB, int8 {:.2f} MB ({:.1f}x smaller)'.format(
+        float_size / 2.0 ** 20, int8_size / 2.0 ** 20, float_size / float(int8_size)))
+
+    if args.max_accuracy_drop is not None and worst_drop > args.max_accuracy_drop:
+        sys.exit('Quantization drops accuracy by {:.4f}, more than the allowed {:.4f}.'.format(
+            worst_drop, args.max_accuracy_drop))
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+# The prediction cache would answer every repeated review without running the model
+os.environ['SENTIMENT_CACHE_SIZE'] = '0'
+
+import numpy as np
+import torch
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+sys.path.insert(0, os.path.join(PROJECT_DIR, 'serve'))
+
+from cold_start import cold_start, write_model_dir
+from predict import model_fn, predict_fn
+from review_files import read_labelled_reviews, run_times
+from utils import ReviewPreprocessor, encode_batch
+from vocab import build_dict
+
+# End-to-end benchmark of the sentiment pipeline on the bundled short_test and long_test
+# reviews, with a small randomly initialized model whose vocabulary is built from those reviews:
+#
+#   python benchmarks/run.py                    # compare against benchmarks/baseline.json
+#   python benchmarks/run.py --update-baseline  # store the results as the new baseline
+#
+# Timings (*_ms) regress when they grow, throughputs (*_per_s) when they shrink, by more than
+# the tolerance stored for the metric in the baseline. Baselines are only comparable on the
+# same kind of machine.
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def run_benchmarks(reviews, args):
+    """Time every stage of the pipeline, return the metrics keyed by name."""
+    metrics = {}
+
+    # A fresh instance per run, so the stem cache starts out cold
+    seconds = min(run_times(lambda: ReviewPreprocessor().transform(reviews), args.repeat))
+    metrics['preprocess_ms_per_review'] = seconds * 1000 / len(reviews)
+
+    words = ReviewPreprocessor().transform(reviews)
+    word_dict = build_dict(words, args.vocab_size, workers=1)
+    seconds = min(run_times(lambda: encode_batch(word_dict, words), args.repeat))
+    metrics['encode_ms_per_review'] = seconds * 1000 / len(reviews)
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        torch.manual_seed(0)
+        write_model_dir(model_dir, args.embedding_dim, args.hidden_dim, args.vocab_size, True, word_dict)
+        metrics['cold_start_ms'] = cold_start(model_dir, args.repeat)[1] * 1000
+
+        model = model_fn(model_dir)
+
+    # One review per call, the way the web app sends them
+    latencies = []
+    for _ in range(args.repeat):
+        for review in reviews:
+            start = time.perf_counter()
+            predict_fn(review, model)
+            latencies.append(time.perf_counter() - start)
+    metrics['single_request_p50_ms'] = float(np.percentile(latencies, 50)) * 1000
+    metrics['single_request_p95_ms'] = float(np.percentile(latencies, 95)) * 1000
+
+    # All reviews in one batch request
+    seconds = float(np.median(run_times(lambda: predict_fn(reviews, model), args.repeat)))
+    metrics['batch_reviews_per_s'] = len(reviews) / seconds
+
+    return metrics
+
+
+def regressions(metrics, baseline, tolerance):
+    """Return (name, value, baseline value) for every metric that got worse by more than tolerance."""
+    found = []
+    tolerances = baseline.get('tolerance', {})
+    for name, expected in baseline['metrics'].items():
+        if name not in metrics:
+            continue
+        allowed = tolerances.get(name, tolerance)
+        value = metrics[name]
+        if name.endswith('_per_s'):
+            worse = value < expected * (1 - allowed)
+        else:
+            worse = value > expected * (1 + allowed)
+        if worse:
+            found.append((name, value, expected))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the sentiment pipeline and compare against a baseline.')
+    parser.add_argument('--data-dirs', nargs='+',
+                        default=[os.path.join(PROJECT_DIR, 'short_test'), os.path.join(PROJECT_DIR, 'long_test')],
+                        help='directories with pos/neg review folders (default: short_test long_test)')
+    parser.add_argument('--embedding_dim', type=int, default=32, metavar='N')
+    parser.add_argument('--hidden_dim', type=int, default=100, metavar='N')
+    parser.add_argument('--vocab_size', type=int, default=5000, metavar='N')
+    parser.add_argument('--repeat', type=int, default=5, metavar='N',
+                        help='number of timed runs per benchmark, odd and at least 5 (default: 5)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, default=BASELINE_PATH,
+                        help='baseline to compare against (default: benchmarks/baseline.json)')
+    parser.add_argument('--tolerance', type=float, default=0.25, metavar='F',
+                        help='allowed relative regression, unless the baseline sets one per metric (default: 0.25)')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store the results as the new baseline instead of comparing')
+    args = parser.parse_args()
+
+    # Fewer runs are dominated by warm-up, and an even count has no middle run for the medians
+    if args.repeat < 5 or args.repeat % 2 == 0:
+        parser.error('--repeat must be odd and at least 5')
+
+    torch.set_num_threads(1)
+    reviews, _ = read_labelled_reviews(args.data_dirs)
+
+    results = {
+        'metrics': run_benchmarks(reviews, args),
+        'environment': {
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'reviews': len(reviews),
+        },
+    }
+
+    print()
+    for name, value in sorted(results['metrics'].items()):
+        print('{:<26} {:10.3f}'.format(name, value))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        # Keep hand-tuned per-metric tolerances of the old baseline
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                results['tolerance'] = json.load(f).get('tolerance', {})
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Baseline written to {}.'.format(args.baseline))
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}, run with --update-baseline to create one.'.format(args.baseline))
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    found = regressions(results['metrics'], baseline, args.tolerance)
+    for name, value, expected in found:
+        print('REGRESSION {}: {:.3f} (baseline {:.3f})'.format(name, value, expected))
+    if found:
+        sys.exit(1)
+    print('No regressions against {}.'.format(args.baseline))
@@ -0,0 +1,118 @@
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve'))
+
+import utils
+from utils import ReviewPreprocessor
+
+# Content addressed cache for preprocessed reviews. Every review is keyed by the hash of its
+# text and stored in one of 256 shards (by the first two hex digits of the hash) below a folder
+# named after the preprocessor version:
+#
+#   <cache_dir>/<version>/<00..ff>.pkl   each a dict {review hash: list of words}
+#
+# The version is a hash of the preprocessing code, so changing it starts a fresh cache, and a
+# rerun after adding reviews only preprocesses the new ones.
+
+_worker_state = {}
+
+
+def preprocessor_version():
+    """Hash of the preprocessing source code, stopword list included."""
+    source = inspect.getsource(ReviewPreprocessor) + inspect.getsource(utils._load_stopwords)
+    stopwords = '\n'.join(sorted(ReviewPreprocessor().stopwords))
+    return hashlib.sha1((source + stopwords).encode('utf-8')).hexdigest()[:16]
+
+
+def review_hash(review):
+    return hashlib.sha1(review.encode('utf-8')).hexdigest()
+
+
+def _shard_path(version_dir, prefix):
+    return os.path.join(version_dir, prefix + '.pkl')
+
+
+def _load_shard(path):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def _write_shard(path, shard):
+    # Shards are swapped in with os.replace, so a reader sees the old shard or the new one and
+    # never half a pickle; the pid keeps concurrent runs out of each other's temporary files
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(shard, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def _init_worker():
+    _worker_state['preprocessor'] = ReviewPreprocessor()
+
+
+def _preprocess_chunk(reviews):
+    return _worker_state['preprocessor'].transform(reviews)
+
+
+def preprocess_reviews(reviews, cache_dir, workers=None, chunk_size=500):
+    """
+    Return the list of words for every review, in order. Reviews found in the cache are read
+    from it, the missing ones are preprocessed in `workers` processes and added to the cache.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    version_dir = os.path.join(cache_dir, preprocessor_version())
+    os.makedirs(version_dir, exist_ok=True)
+
+    hashes = [review_hash(review) for review in reviews]
+
+    # Only the shards holding one of our reviews are read
+    shards = {}
+    for key in hashes:
+        prefix = key[:2]
+        if prefix not in shards:
+            shards[prefix] = _load_shard(_shard_path(version_dir, prefix))
+
+    missing = {}
+    for key, review in zip(hashes, reviews):
+        if key not in shards[key[:2]] and key not in missing:
+            missing[key] = review
+
+    print('{} of {} reviews found in the preprocessing cache'.format(len(reviews) - len(missing), len(reviews)))
+
+    if missing:
+        keys = list(missing)
+        texts = [missing[key] for key in keys]
+        chunks = [texts[idx:idx + chunk_size] for idx in range(0, len(texts), chunk_size)]
+
+        if workers <= 1:
+            _init_worker()
+            results = map(_preprocess_chunk, chunks)
+            words = [tokens for chunk in results for tokens in chunk]
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker) as executor:
+                words = [tokens for chunk in executor.map(_preprocess_chunk, chunks) for tokens in chunk]
+
+        touched = set()
+        for key, tokens in zip(keys, words):
+            shards[key[:2]][key] = tokens
+            touched.add(key[:2])
+        for prefix in touched:
+            _write_shard(_shard_path(version_dir, prefix), shards[prefix])
+
+    return [shards[key[:2]][key] for key in hashes]
+
+
+def preprocess_data(data_train, data_test, labels_train, labels_test,
+                    cache_dir=os.path.join("../cache", "sentiment_analysis"), workers=None):
+    """Convert each review to words; read from cache if available."""
+    words_train = preprocess_reviews(data_train, cache_dir, workers)
+    words_test = preprocess_reviews(data_test, cache_dir, workers)
+    return words_train, words_test, labels_train, labels_test
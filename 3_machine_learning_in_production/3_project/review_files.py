@@ -0,0 +1,46 @@
+import glob
+import os
+import time
+
+import numpy as np
+
+# Shared helpers of the batch scorer and the benchmarks: finding and reading the review files of
+# directories laid out like short_test and long_test (pos/neg subfolders of *.txt files), and
+# timing repeated runs of a function.
+
+
+def find_reviews(data_dirs):
+    """Return (path, label) pairs for every review, label is None for unlabelled directories."""
+    reviews = []
+    for data_dir in data_dirs:
+        labelled = False
+        for sentiment, label in [('pos', 1), ('neg', 0)]:
+            files = sorted(glob.glob(os.path.join(data_dir, sentiment, '*.txt')))
+            labelled = labelled or len(files) > 0
+            reviews.extend((f, label) for f in files)
+        if not labelled:
+            reviews.extend((f, None) for f in sorted(glob.glob(os.path.join(data_dir, '*.txt'))))
+    return reviews
+
+
+def read_review(path):
+    """Read the text of one review file."""
+    with open(path, encoding='utf-8', errors='ignore') as review:
+        return review.read()
+
+
+def read_labelled_reviews(data_dirs):
+    """Read the reviews below the pos/neg folders of the given directories with their labels (1 / 0)."""
+    paths = [(path, label) for path, label in find_reviews(data_dirs) if label is not None]
+    reviews = [read_review(path) for path, _ in paths]
+    return reviews, np.array([label for _, label in paths])
+
+
+def run_times(fn, repeat):
+    """Run fn `repeat` times and return the duration of every run, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
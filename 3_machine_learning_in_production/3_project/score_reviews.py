@@ -0,0 +1,156 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve'))
+
+from predict import model_fn, predict_rows
+from utils import DEFAULT_PAD, ReviewPreprocessor, encode_batch
+from review_files import find_reviews, read_review
+
+# Batch scoring of review directories without an endpoint: worker processes read, preprocess
+# and encode the reviews, the main process runs the model on large batches and streams the
+# results to a CSV or JSON lines file.
+#
+#   python score_reviews.py --model-dir model --output scores.csv long_test short_test
+#
+# Directories with pos/neg subfolders (like short_test and long_test) are labelled by folder and
+# the accuracy is reported at the end; any other directory is scored without labels.
+
+_worker_state = {}
+
+
+def _init_worker(word_dict, pad):
+    # Every worker builds its preprocessor once and keeps it for all of its chunks
+    _worker_state['preprocessor'] = ReviewPreprocessor()
+    _worker_state['word_dict'] = word_dict
+    _worker_state['pad'] = pad
+
+
+def _encode_files(paths):
+    """Read, preprocess and encode a chunk of review files into 'len, review[pad]' rows."""
+    preprocessor = _worker_state['preprocessor']
+    words = []
+    for path in paths:
+        words.append(preprocessor(read_review(path)))
+    return encode_batch(_worker_state['word_dict'], words, pad=_worker_state['pad'])
+
+
+def encoded_chunks(executor, paths, chunk_size, prefetch):
+    """
+    Yield the encoded rows chunk by chunk, in order. At most `prefetch` chunks are in flight, so
+    memory stays bounded however many reviews there are.
+    """
+    chunks = (paths[idx:idx + chunk_size] for idx in range(0, len(paths), chunk_size))
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(_encode_files, chunk))
+        if len(pending) >= prefetch:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class ResultWriter(object):
+    """Streams one result row per review to a CSV or, for *.jsonl / *.json, a JSON lines file."""
+
+    FIELDS = ['file', 'label', 'probability', 'prediction']
+
+    def __init__(self, path):
+        self.jsonl = path.endswith('.jsonl') or path.endswith('.json')
+        self.file = open(path, 'w', newline='')
+        if not self.jsonl:
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(self.FIELDS)
+
+    def write(self, path, label, probability):
+        row = [path, label, float(probability), int(round(probability))]
+        if self.jsonl:
+            self.file.write(json.dumps(dict(zip(self.FIELDS, row))) + '\n')
+        else:
+            self.writer.writerow(['' if value is None else value for value in row])
+
+    def close(self):
+        self.file.close()
+
+
+def batches(chunks, batch_size):
+    """Stack encoded chunks into matrices of at least batch_size rows (except for the last one)."""
+    pending = []
+    count = 0
+    for rows in chunks:
+        pending.append(rows)
+        count += len(rows)
+        if count >= batch_size:
+            yield np.vstack(pending)
+            pending = []
+            count = 0
+    if pending:
+        yield np.vstack(pending)
+
+
+def score(model, reviews, writer, workers, batch_size, chunk_size, pad=None):
+    """
+    Score (path, label) pairs with the model and write every result. Returns the number of
+    scored reviews, the number of labelled ones and how many of those were predicted correctly.
+    Reviews are cut to the pad length the model was trained with, unless pad is given.
+    """
+    pad = getattr(model, 'pad', DEFAULT_PAD) if pad is None else pad
+    paths = [path for path, _ in reviews]
+    scored = labelled = correct = 0
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(dict(model.word_dict), pad)) as executor:
+        chunks = encoded_chunks(executor, paths, chunk_size, prefetch=2 * workers)
+        for data in batches(chunks, batch_size):
+            probabilities = predict_rows(data, model)
+            for (path, label), probability in zip(reviews[scored:scored + len(data)], probabilities):
+                writer.write(path, label, probability)
+                if label is not None:
+                    labelled += 1
+                    correct += int(round(probability) == label)
+            scored += len(data)
+
+    return scored, labelled, correct
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score directories of reviews with a trained sentiment model.')
+
+    parser.add_argument('data_dirs', nargs='+',
+                        help='directories with pos/neg subfolders or plain *.txt reviews')
+    parser.add_argument('--model-dir', type=str, required=True,
+                        help='directory with the trained model (model.bin or the three model files)')
+    parser.add_argument('--output', type=str, default='scores.csv',
+                        help='result file, *.jsonl for JSON lines, anything else for CSV (default: scores.csv)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), metavar='N',
+                        help='number of preprocessing processes (default: number of cores)')
+    parser.add_argument('--batch-size', type=int, default=1024, metavar='N',
+                        help='reviews per forward pass (default: 1024)')
+    parser.add_argument('--chunk-size', type=int, default=256, metavar='N',
+                        help='reviews per preprocessing task (default: 256)')
+
+    args = parser.parse_args()
+
+    model = model_fn(args.model_dir)
+    reviews = find_reviews(args.data_dirs)
+    print('Scoring {} reviews with {} workers.'.format(len(reviews), args.workers))
+
+    writer = ResultWriter(args.output)
+    start = time.perf_counter()
+    try:
+        scored, labelled, correct = score(model, reviews, writer, args.workers, args.batch_size, args.chunk_size)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+
+    print('Scored {} reviews in {:.1f}s ({:.0f} reviews/s), results in {}.'.format(
+        scored, elapsed, scored / elapsed if elapsed > 0 else 0.0, args.output))
+    if labelled:
+        print('Accuracy on {} labelled reviews: {:.4f}'.format(labelled, correct / float(labelled)))
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache(object):
+    """
+    Size bounded LRU cache, with an optional time to live, for sentiment probabilities. Entries
+    are keyed on a hash of the encoded 'len, review[pad]' row, so every review that normalizes to
+    the same stemmed words shares one entry.
+
+    The cache remembers which model and word_dict its entries were computed with (see bind) and
+    empties itself as soon as it is used with a different one.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        """
+        max_size - Maximum number of entries, 0 disables the cache.
+        ttl      - Seconds an entry stays valid, None keeps entries until they are evicted.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._model = None
+        self._word_dict = None
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @staticmethod
+    def key(row):
+        """Hash an encoded review row into a cache key."""
+        return hashlib.blake2b(row.tobytes(), digest_size=16).digest()
+
+    def bind(self, model):
+        """Clear the cache if it was filled by a different model or word_dict than this one."""
+        with self._lock:
+            if self._model is not model or self._word_dict is not model.word_dict:
+                self._entries.clear()
+                self._model = model
+                self._word_dict = model.word_dict
+
+    def get(self, key):
+        """Return the cached probability for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store a probability, evicting the least recently used entry when the cache is full."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return the hit/miss counters and the current number of entries."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+            }
@@ -0,0 +1,90 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Bucket upper bounds in seconds: 20 log-spaced buckets per decade from 1 microsecond to 100
+# seconds, so a reported percentile is never off by more than ~12%
+_BUCKETS = [10 ** (exponent / 20.0) for exponent in range(-120, 41)]
+
+
+class LatencyHistogram(object):
+    """
+    Constant memory latency histogram. Recording a sample is a binary search plus a counter
+    increment; percentiles are read from the bucket counts.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile (0 < q <= 100), in seconds."""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                # The last bucket is open ended, the largest sample is the best bound there
+                return min(_BUCKETS[idx], self.max) if idx < len(_BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        """Count plus mean, p50, p95, p99 and max latency in milliseconds."""
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000,
+        }
+
+
+class StageMetrics(object):
+    """A latency histogram per named pipeline stage."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the body of a with block and record it under stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return the summary of every stage, keyed by stage name."""
+        with self._lock:
+            return {stage: histogram.summary() for stage, histogram in self._histograms.items()}
+
+    def dump(self):
+        """The snapshot as a JSON string, e.g. for the log."""
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
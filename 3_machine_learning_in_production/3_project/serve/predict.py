@@ -1,91 +1,265 @@
 import argparse
+import itertools
 import json
+import logging
 import os
 import pickle
 import sys
-import sagemaker_containers
 import pandas as pd
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.utils.data
+from io import BytesIO
 
 from model import LSTMClassifier
+from artifact import ARTIFACT_NAME, load_artifact
+from cache import PredictionCache
+from metrics import StageMetrics
 
-from utils import review_to_words, convert_and_pad
+from utils import DEFAULT_PAD, ReviewPreprocessor, review_to_words, encode_batch
 
-def model_fn(model_dir):
-    """Load the PyTorch model from the `model_dir` directory."""
-    print("Loading model.")
+# single review in, rounded sentiment out (what the web app uses)
+TEXT_CONTENT_TYPE = 'text/plain'
+# batch input: one review per line, or one JSON string / {"review": ...} object per line
+NDTEXT_CONTENT_TYPE = 'application/x-ndtext'
+JSONLINES_CONTENT_TYPE = 'application/jsonlines'
+# batch output: a JSON array or a NPY vector with one probability per review
+JSON_CONTENT_TYPE = 'application/json'
+NPY_CONTENT_TYPE = 'application/x-npy'
+
+# set this environment variable to 1 (e.g. through PyTorchModel(env=...)) to serve the int8
+# dynamically quantized model on CPU instead of the float one
+QUANTIZE_ENV = 'SENTIMENT_QUANTIZE'
+
+# size (0 disables it) and time to live in seconds of the in-process prediction cache
+CACHE_SIZE_ENV = 'SENTIMENT_CACHE_SIZE'
+CACHE_TTL_ENV = 'SENTIMENT_CACHE_TTL'
+
+prediction_cache = PredictionCache(
+    max_size=int(os.environ.get(CACHE_SIZE_ENV, 10000)),
+    ttl=float(os.environ[CACHE_TTL_ENV]) if os.environ.get(CACHE_TTL_ENV) else None)
+
+# latency histograms for every stage of a request; set the environment variable to N to log
+# them every N calls of predict_fn
+METRICS_LOG_EVERY_ENV = 'SENTIMENT_METRICS_LOG_EVERY'
+
+stage_metrics = StageMetrics()
+_metrics_log_every = int(os.environ.get(METRICS_LOG_EVERY_ENV, 0))
+_predict_calls = itertools.count(1)
 
+logger = logging.getLogger(__name__)
+
+def _load_model_files(model_dir):
+    """Read model_info, the model parameters and the word_dict from their three separate files."""
     # First, load the parameters used to create the model.
     model_info = {}
     model_info_path = os.path.join(model_dir, 'model_info.pth')
     with open(model_info_path, 'rb') as f:
         model_info = torch.load(f)
 
-    print("model_info: {}".format(model_info))
-
-    # Determine the device and construct the model.
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = LSTMClassifier(model_info['embedding_dim'], model_info['hidden_dim'], model_info['vocab_size'])
-
     # Load the store model parameters.
     model_path = os.path.join(model_dir, 'model.pth')
     with open(model_path, 'rb') as f:
-        model.load_state_dict(torch.load(f))
+        state_dict = torch.load(f)
 
     # Load the saved word_dict.
     word_dict_path = os.path.join(model_dir, 'word_dict.pkl')
     with open(word_dict_path, 'rb') as f:
-        model.word_dict = pickle.load(f)
+        word_dict = pickle.load(f)
+
+    return model_info, state_dict, word_dict
+
+def quantize_model(model):
+    """
+    Dynamically quantize the LSTM and the dense layer of the model to int8, in place. Weights are
+    stored as int8 and activations are quantized on the fly, which only pays off on CPU.
+    """
+    return torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def model_fn(model_dir):
+    """Load the PyTorch model from the `model_dir` directory."""
+    print("Loading model.")
+
+    # Prefer the single memory-mapped artifact, if training wrote one.
+    artifact_path = os.path.join(model_dir, ARTIFACT_NAME)
+    if os.path.exists(artifact_path):
+        model_info, state_dict, word_dict = load_artifact(artifact_path)
+    else:
+        model_info, state_dict, word_dict = _load_model_files(model_dir)
+
+    print("model_info: {}".format(model_info))
+
+    # Determine the device and construct the model.
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = LSTMClassifier(model_info['embedding_dim'], model_info['hidden_dim'], model_info['vocab_size'])
+
+    # Use the (possibly memory-mapped) tensors as they are instead of copying them into the model.
+    try:
+        model.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        model.load_state_dict(state_dict)
+
+    model.word_dict = word_dict
+
+    # Reviews are cut to the pad length chosen during training, models from before that used 500
+    model.pad = model_info.get('pad', DEFAULT_PAD)
+
+    # Set up the text preprocessing once, rather than for every request.
+    model.preprocessor = ReviewPreprocessor()
 
     model.to(device).eval()
 
+    if os.environ.get(QUANTIZE_ENV, '0').lower() in ('1', 'true', 'yes'):
+        if device.type == 'cpu':
+            print("Quantizing model to int8.")
+            model = quantize_model(model)
+        else:
+            print("Quantization is only supported on CPU, serving the float model.")
+
     print("Done loading model.")
     return model
 
+def _split_lines(data):
+    """
+    One entry per line of a batch payload. Only '\n' (with an optional '\r' before it) ends a
+    line, and a blank line stays as an empty review, so every line gets its result back at its
+    own position. A final newline does not start another review.
+    """
+    lines = data.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return [line[:-1] if line.endswith('\r') else line for line in lines]
+
+def _parse_json_line(line):
+    # A blank line is scored as an empty review, like in the plain text batch format
+    if not line.strip():
+        return ''
+    record = json.loads(line)
+    if isinstance(record, dict):
+        return record['review']
+    return record
+
 def input_fn(serialized_input_data, content_type):
-    print('Deserializing the input data.')
-    if content_type == 'text/plain':
-        data = serialized_input_data.decode('utf-8')
-        return data
+    logger.debug('Deserializing the input data.')
+    with stage_metrics.timer('input_fn'):
+        if content_type == TEXT_CONTENT_TYPE:
+            data = serialized_input_data.decode('utf-8')
+            return data
+        if content_type == NDTEXT_CONTENT_TYPE:
+            return _split_lines(serialized_input_data.decode('utf-8'))
+        if content_type == JSONLINES_CONTENT_TYPE:
+            lines = _split_lines(serialized_input_data.decode('utf-8'))
+            return [_parse_json_line(line) for line in lines]
     raise Exception('Requested unsupported ContentType in content_type: ' + content_type)
 
 def output_fn(prediction_output, accept):
-    print('Serializing the generated output.')
-    return str(prediction_output)
+    logger.debug('Serializing the generated output.')
+    with stage_metrics.timer('output_fn'):
+        if accept == JSON_CONTENT_TYPE:
+            return json.dumps(np.asarray(prediction_output).reshape(-1).tolist()), accept
+        if accept == NPY_CONTENT_TYPE:
+            stream = BytesIO()
+            np.save(stream, np.asarray(prediction_output).reshape(-1))
+            return stream.getvalue(), accept
+        if np.ndim(prediction_output) > 0:
+            # A batch asked for as plain text gets one probability per line
+            return '\n'.join(str(value) for value in prediction_output)
+        return str(prediction_output)
 
-def predict_fn(input_data, model):
-    print('Inferring sentiment of input data.')
+def encode_reviews(reviews, model, pad=None):
+    """
+    Convert raw reviews into a matrix of 'len, review[pad]' rows, which the model expects. The
+    pad length defaults to the one the model was trained with.
+    """
+    pad = getattr(model, 'pad', DEFAULT_PAD) if pad is None else pad
+    preprocessor = getattr(model, 'preprocessor', None) or review_to_words
+    with stage_metrics.timer('review_to_words'):
+        words = [preprocessor(review) for review in reviews]
+    with stage_metrics.timer('convert_and_pad'):
+        return encode_batch(model.word_dict, words, pad=pad)
+
+def encode_review(review, model, pad=None):
+    """Convert a raw review into the 'len, review[pad]' row the model expects."""
+    return encode_reviews([review], model, pad=pad)[0]
 
+def predict_rows(rows, model):
+    """
+    Run a batch of encoded rows (see encode_reviews) through the model in a single forward
+    pass and return one sentiment probability per row.
+    """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    
-    if model.word_dict is None:
-        raise Exception('Model has not been loaded properly, no word_dict.')
-    
-    # TODO: Process input_data so that it is ready to be sent to our model.
-    #       You should produce two variables:
-    #         data_X   - A sequence of length 500 which represents the converted review
-    #         data_len - The length of the review
-    input_data = review_to_words(input_data)
-    data_X, data_len = convert_and_pad(model.word_dict, input_data, pad=500)
-
-    # Using data_X and data_len we construct an appropriate input tensor. Remember
-    # that our model expects input data of the form 'len, review[500]'.
-    data_pack = np.hstack((data_len, data_X))
-    data_pack = data_pack.reshape(1, -1)
-    
-    data = torch.from_numpy(data_pack)
+
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.float32)
+
+    if isinstance(rows, list):
+        rows = np.vstack(rows)
+
+    # encode_batch already produces a contiguous int64 matrix, so no copy is made here
+    data = torch.from_numpy(rows).long()
     data = data.to(device)
 
-    # Make sure to put the model into evaluation mode
     model.eval()
 
-    # TODO: Compute the result of applying the model to the input data. The variable `result` should
-    #       be a numpy array which contains a single integer which is either 1 or 0
-    output = model(data)
-    result = output.detach().numpy().round()
+    with torch.no_grad(), stage_metrics.timer('forward'):
+        output = model(data)
+
+    # The model squeezes its output, so a batch of one comes back as a scalar
+    return output.cpu().numpy().reshape(-1)
+
+def predict_rows_cached(rows, model, cache=None):
+    """
+    Same as predict_rows, but answers rows seen before from the prediction cache and only runs
+    the remaining ones through the model.
+    """
+    cache = prediction_cache if cache is None else cache
+    if not cache.enabled or len(rows) == 0:
+        return predict_rows(rows, model)
+
+    if isinstance(rows, list):
+        rows = np.vstack(rows)
+
+    cache.bind(model)
+
+    keys = [cache.key(row) for row in rows]
+    result = np.empty(len(rows), dtype=np.float32)
+    missing = []
+    for idx, key in enumerate(keys):
+        value = cache.get(key)
+        if value is None:
+            missing.append(idx)
+        else:
+            result[idx] = value
+
+    if missing:
+        probabilities = predict_rows(rows[missing], model)
+        result[missing] = probabilities
+        for idx, probability in zip(missing, probabilities):
+            cache.put(keys[idx], probability)
+
+    return result
+
+def _log_metrics():
+    if _metrics_log_every > 0 and next(_predict_calls) % _metrics_log_every == 0:
+        logger.info('Stage latencies: %s', stage_metrics.dump())
+
+def predict_fn(input_data, model):
+    logger.debug('Inferring sentiment of input data.')
+    _log_metrics()
+
+    if model.word_dict is None:
+        raise Exception('Model has not been loaded properly, no word_dict.')
+
+    if isinstance(input_data, list):
+        # Batch requests are scored as one tensor and get the probability of each review back
+        return predict_rows_cached(encode_reviews(input_data, model), model)
+    
+    # Convert the review into a row of the form 'len, review[pad]', which is what our model expects
+    data_pack = encode_reviews([input_data], model)
+
+    # The result is a numpy array which contains a single value which is either 1 or 0
+    result = predict_rows_cached(data_pack, model)[0].round()
 
     return result
@@ -0,0 +1,221 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from predict import model_fn, input_fn, output_fn, predict_fn, encode_review, predict_rows, prediction_cache, stage_metrics
+
+
+class _PendingRequest(object):
+    """A single encoded review waiting for its slot in a batch."""
+
+    def __init__(self, row):
+        self.row = row
+        self.key = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    Collects reviews submitted by concurrent callers and runs them through the model as one
+    padded batch. A batch is closed as soon as it holds `max_batch_size` reviews or the first
+    review in it has waited `max_wait_ms` milliseconds, whichever comes first.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=10, verbose=True, cache=None):
+        self.model = model
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.verbose = verbose
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_count = 0
+        self._request_count = 0
+        self._size_counts = [0] * (max_batch_size + 1)
+
+        self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._worker.start()
+
+    def predict(self, review):
+        """Encode a raw review, wait for the batch it ends up in and return its probability."""
+        request = _PendingRequest(encode_review(review, self.model))
+
+        # Reviews the cache has seen before do not have to wait for a batch at all
+        if self.cache is not None and self.cache.enabled:
+            self.cache.bind(self.model)
+            request.key = self.cache.key(request.row)
+            cached = self.cache.get(request.key)
+            if cached is not None:
+                return cached
+
+        self._queue.put(request)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        """Return the number of batches, requests and the batch occupancy seen so far."""
+        with self._lock:
+            batches = self._batch_count
+            requests = self._request_count
+            sizes = {size: count for size, count in enumerate(self._size_counts) if count > 0}
+
+        return {
+            'batches': batches,
+            'requests': requests,
+            'max_batch_size': self.max_batch_size,
+            'mean_batch_size': requests / batches if batches else 0.0,
+            'mean_occupancy': requests / float(batches * self.max_batch_size) if batches else 0.0,
+            'batch_sizes': sizes,
+        }
+
+    def _collect(self):
+        # Block until the first request arrives, then keep the window open for at most max_wait
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            try:
+                results = predict_rows([request.row for request in batch], self.model)
+                for request, result in zip(batch, results):
+                    request.result = result
+                    if request.key is not None:
+                        self.cache.put(request.key, result)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            self._record(len(batch))
+
+            for request in batch:
+                request.done.set()
+
+    def _record(self, size):
+        with self._lock:
+            self._batch_count += 1
+            self._request_count += size
+            self._size_counts[size] += 1
+            batch_count = self._batch_count
+
+        if self.verbose:
+            print('Batch {}: {}/{} reviews ({:.0%} occupancy)'.format(
+                batch_count, size, self.max_batch_size, size / float(self.max_batch_size)))
+
+
+def make_handler(batcher):
+    """Build a request handler class that answers through the given MicroBatcher."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            content_type = self.headers.get('Content-Type', 'text/plain')
+            accept = self.headers.get('Accept', 'text/plain')
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+            try:
+                data = input_fn(body, content_type)
+                if isinstance(data, list):
+                    # Batch payloads are already a batch, score them directly
+                    result = predict_fn(data, batcher.model)
+                else:
+                    result = batcher.predict(data).round()
+                response = output_fn(result, accept)
+            except Exception as e:
+                self._send(400, str(e).encode('utf-8'), 'text/plain')
+                return
+
+            if isinstance(response, tuple):
+                response, response_type = response
+            else:
+                response_type = 'text/plain'
+            if isinstance(response, str):
+                response = response.encode('utf-8')
+
+            self._send(200, response, response_type)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                stats = batcher.stats()
+                stats['cache'] = prediction_cache.stats()
+            elif self.path == '/metrics':
+                stats = stage_metrics.snapshot()
+            else:
+                self._send(404, b'Not found', 'text/plain')
+                return
+            self._send(200, json.dumps(stats).encode('utf-8'), 'application/json')
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Keep the console for the per-batch occupancy lines
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    # Local serving mode: POST a review (or a batch, see predict.input_fn) to / and get the same
+    # answer the SageMaker endpoint would give, GET /stats for the batch occupancy and cache
+    # counters and GET /metrics for the latency percentiles of every stage.
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--model-dir', type=str, required=True,
+                        help='directory holding model_info.pth, model.pth and word_dict.pkl')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='interface to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on (default: 8080)')
+    parser.add_argument('--max-batch-size', type=int, default=32, metavar='N',
+                        help='maximum number of reviews per forward pass (default: 32)')
+    parser.add_argument('--max-wait-ms', type=float, default=10, metavar='MS',
+                        help='maximum time a review waits for its batch to fill (default: 10)')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not print the occupancy of every batch')
+
+    args = parser.parse_args()
+
+    model = model_fn(args.model_dir)
+    batcher = MicroBatcher(model, args.max_batch_size, args.max_wait_ms, verbose=not args.quiet,
+                           cache=prediction_cache)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher))
+    print('Serving on http://{}:{} (max batch size {}, max wait {} ms)'.format(
+        args.host, args.port, args.max_batch_size, args.max_wait_ms))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Batch stats: {}'.format(batcher.stats()))
+        print('Cache stats: {}'.format(prediction_cache.stats()))
+        print('Stage latencies: {}'.format(stage_metrics.dump()))
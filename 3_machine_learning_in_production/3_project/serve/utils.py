@@ -9,23 +9,73 @@ import pickle
 
 import os
 import glob
+import functools
+import itertools
+
+import numpy as np
+
+def _load_stopwords():
+    """Return the english stopword list, downloading the corpus only if it is not there yet."""
+    try:
+        return stopwords.words("english")
+    except LookupError:
+        nltk.download("stopwords", quiet=True)
+        return stopwords.words("english")
+
+class ReviewPreprocessor(object):
+    """
+    Turns a raw review into the list of stemmed words used by the model. All of the set up
+    (stopwords, regexes, stemmer) happens once in the constructor, so build one instance and
+    reuse it for every review.
+    """
+
+    def __init__(self, stem_cache_size=100000):
+        """
+        stem_cache_size - Number of distinct words whose stem is remembered (LRU).
+        """
+        self.stem_cache_size = stem_cache_size
+        self.stopwords = frozenset(_load_stopwords())
+        self.non_alphanumeric = re.compile(r"[^a-zA-Z0-9]")
+        self.markup = re.compile(r"[<&]")
+        self.stem = functools.lru_cache(maxsize=stem_cache_size)(PorterStemmer().stem)
+
+    def __call__(self, review):
+        # Only hand the review to BeautifulSoup if there is markup for it to remove
+        if self.markup.search(review):
+            review = BeautifulSoup(review, "html.parser").get_text() # Remove HTML tags
+        text = self.non_alphanumeric.sub(" ", review.lower()) # Convert to lower case
+        stem = self.stem
+        stop = self.stopwords
+        return [stem(w) for w in text.split() if w not in stop] # Remove stopwords and stem
+
+    def transform(self, reviews):
+        """Preprocess a list of reviews, returning one list of words per review."""
+        return [self(review) for review in reviews]
+
+    def __getstate__(self):
+        # The stem cache wraps a bound method and cannot be pickled, rebuild it instead
+        return {'stem_cache_size': self.stem_cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+_default_preprocessor = None
 
 def review_to_words(review):
-    nltk.download("stopwords", quiet=True)
-    stemmer = PorterStemmer()
-    
-    text = BeautifulSoup(review, "html.parser").get_text() # Remove HTML tags
-    text = re.sub(r"[^a-zA-Z0-9]", " ", text.lower()) # Convert to lower case
-    words = text.split() # Split string into words
-    words = [w for w in words if w not in stopwords.words("english")] # Remove stopwords
-    words = [PorterStemmer().stem(w) for w in words] # stem
-    
-    return words
+    """Preprocess a single review with a shared ReviewPreprocessor."""
+    global _default_preprocessor
+    if _default_preprocessor is None:
+        _default_preprocessor = ReviewPreprocessor()
+    return _default_preprocessor(review)
 
-def convert_and_pad(word_dict, sentence, pad=500):
-    NOWORD = 0 # We will use 0 to represent the 'no word' category
-    INFREQ = 1 # and we use 1 to represent the infrequent words, i.e., words not appearing in word_dict
-    
+NOWORD = 0 # We will use 0 to represent the 'no word' category
+INFREQ = 1 # and we use 1 to represent the infrequent words, i.e., words not appearing in word_dict
+
+# Reviews are cut (or padded) to this many words, unless model_info holds the pad length the
+# model was trained with
+DEFAULT_PAD = 500
+
+def convert_and_pad(word_dict, sentence, pad=DEFAULT_PAD):
     working_sentence = [NOWORD] * pad
     
     for word_index, word in enumerate(sentence[:pad]):
@@ -34,4 +84,30 @@ def convert_and_pad(word_dict, sentence, pad=500):
         else:
             working_sentence[word_index] = INFREQ
             
-    return working_sentence, min(len(sentence), pad)
\ No newline at end of file
+    return working_sentence, min(len(sentence), pad)
+
+def encode_batch(word_dict, sentences, pad=DEFAULT_PAD, dtype=np.int64):
+    """
+    Convert and pad a list of sentences into one preallocated matrix of shape
+    (len(sentences), pad + 1) laid out as 'len, review[pad]', which is exactly what
+    LSTMClassifier expects. The matrix is C-contiguous, so torch.from_numpy can use it
+    without copying.
+    """
+    data = np.zeros((len(sentences), pad + 1), dtype=dtype)
+
+    sentences = [sentence[:pad] for sentence in sentences]
+    lengths = np.fromiter((len(sentence) for sentence in sentences), dtype=dtype, count=len(sentences))
+    data[:, 0] = lengths
+
+    # Look up every word of the batch in one pass and scatter the ids into place; a boolean
+    # mask assignment fills row by row, which is the order the words were chained in
+    words = list(itertools.chain.from_iterable(sentences))
+    ids = np.fromiter(map(word_dict.get, words, itertools.repeat(INFREQ)), dtype=dtype, count=len(words))
+    data[:, 1:][np.arange(pad) < lengths[:, None]] = ids
+
+    return data
+
+def convert_and_pad_data(word_dict, data, pad=DEFAULT_PAD):
+    """Batch version of convert_and_pad, returns the padded reviews and their lengths."""
+    encoded = encode_batch(word_dict, data, pad)
+    return encoded[:, 1:], encoded[:, 0]
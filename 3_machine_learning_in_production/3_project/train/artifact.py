@@ -0,0 +1,130 @@
+import json
+import mmap
+import struct
+import threading
+from collections.abc import Mapping
+
+import numpy as np
+import torch
+
+# Single file model artifact: everything model_fn needs (model_info, the weights and the
+# vocabulary) in one file that can be memory-mapped instead of deserialized.
+#
+#   magic (8 bytes) | header size (uint64) | JSON header | blocks, each 64-byte aligned
+#
+# The header holds model_info and the dtype, shape and offset of every block. The vocabulary is
+# stored as the words joined by newlines plus an int32 array with their ids.
+
+ARTIFACT_NAME = 'model.bin'
+
+_MAGIC = b'LSTMCLF1'
+_PREAMBLE = struct.Struct('<8sQ')
+_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def save_artifact(path, model_info, state_dict, word_dict):
+    """Write model_info, a model state_dict and a word_dict to a single artifact file."""
+    words = sorted(word_dict, key=word_dict.get)
+    if any('\n' in word for word in words):
+        raise ValueError('Words containing a newline cannot be stored in the artifact.')
+
+    blocks = []
+    for name, tensor in state_dict.items():
+        blocks.append((name, tensor.detach().cpu().contiguous().numpy()))
+    blocks.append(('vocab.ids', np.array([word_dict[word] for word in words], dtype=np.int32)))
+    blocks.append(('vocab.words', np.frombuffer('\n'.join(words).encode('utf-8'), dtype=np.uint8)))
+
+    # Offsets are relative to the start of the data section, which follows the header
+    entries = []
+    offset = 0
+    for name, array in blocks:
+        entries.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({'model_info': model_info, 'blocks': entries}).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(_MAGIC, len(header)))
+        f.write(header)
+        for entry, (_, array) in zip(entries, blocks):
+            f.seek(data_start + entry['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+
+class LazyWordDict(Mapping):
+    """
+    A read-only word_dict that is only decoded from the artifact the first time it is used, so
+    workers that never see a request do not pay for it.
+    """
+
+    def __init__(self, words, ids):
+        self._pending = (words, ids)
+        self._dict = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._dict is None:
+            # The threaded server can ask several handler threads for the first lookup at once,
+            # only one of them decodes while the others wait for its dict
+            with self._lock:
+                if self._dict is None:
+                    words, ids = self._pending
+                    word_dict = dict(zip(words.tobytes().decode('utf-8').split('\n'), ids.tolist()))
+                    # From now on lookups go straight to the dict, without this wrapper in between
+                    self.get = word_dict.get
+                    self._dict = word_dict
+                    self._pending = None
+        return self._dict
+
+    def __getitem__(self, word):
+        return self._load()[word]
+
+    def __contains__(self, word):
+        return word in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def get(self, word, default=None):
+        return self._load().get(word, default)
+
+    def __reduce__(self):
+        # Pickles (e.g. word_dict.pkl) hold a plain dict
+        return (dict, (self._load(),))
+
+
+def load_artifact(path):
+    """
+    Memory-map an artifact written by save_artifact and return (model_info, state_dict,
+    word_dict). The tensors share memory with the mapped file, so pages are only read from disk
+    when they are touched.
+    """
+    with open(path, 'rb') as f:
+        magic, header_size = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if magic != _MAGIC:
+            raise Exception('{} is not a model artifact.'.format(path))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+        # A private (copy-on-write) mapping gives writable arrays without touching the file
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = _align(_PREAMBLE.size + header_size)
+    arrays = {}
+    for entry in header['blocks']:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + entry['offset'])
+        arrays[entry['name']] = array.reshape(entry['shape'])
+
+    word_dict = LazyWordDict(arrays.pop('vocab.words'), arrays.pop('vocab.ids'))
+    state_dict = {name: torch.from_numpy(array) for name, array in arrays.items()}
+
+    return header['model_info'], state_dict, word_dict
@@ -0,0 +1,100 @@
+import glob
+import os
+import random
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+# Training checkpoints: one checkpoint-<epoch>.pth file per saved epoch, holding the model and
+# optimizer state, the random number generator states and the progress of early stopping.
+# Only the newest `keep` files are kept; training resumes from the newest one.
+
+_PATTERN = 'checkpoint-{:04d}.pth'
+
+
+def _load(path):
+    # The checkpoint holds numpy RNG state as well, which newer versions of torch.load refuse
+    # to read unless weights_only is turned off
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+
+def _is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+class Checkpointer(object):
+    """
+    Saves and restores training checkpoints in checkpoint_dir. Only the process with save=True
+    (rank 0) writes, since the others hold identical copies of the model. In a data-parallel run
+    rank 0 also reads the newest checkpoint and sends it to every other process, so all of them
+    resume from the same epoch whatever is in their own checkpoint_dir.
+    """
+
+    def __init__(self, checkpoint_dir, every=1, keep=2, save=True):
+        self.checkpoint_dir = checkpoint_dir
+        self.every = every
+        self.keep = keep
+        self.save_enabled = save and every > 0
+
+    def _paths(self):
+        return sorted(glob.glob(os.path.join(self.checkpoint_dir, _PATTERN.replace('{:04d}', '[0-9]*'))))
+
+    def restore(self, model, optimizer):
+        """
+        Load the newest checkpoint into the model and optimizer and reset the random number
+        generators. Returns the saved training state, or None if there is no checkpoint.
+        """
+        distributed = _is_distributed()
+        checkpoint = None
+        if not distributed or dist.get_rank() == 0:
+            paths = self._paths()
+            checkpoint = _load(paths[-1]) if paths else None
+
+        if distributed:
+            received = [checkpoint]
+            dist.broadcast_object_list(received, src=0)
+            checkpoint = received[0]
+
+        if checkpoint is None:
+            return None
+
+        getattr(model, 'module', model).load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+
+        torch.set_rng_state(checkpoint['rng']['torch'])
+        np.random.set_state(checkpoint['rng']['numpy'])
+        random.setstate(checkpoint['rng']['python'])
+
+        print("Resumed from the checkpoint of epoch {}.".format(checkpoint['state']['epoch']))
+        return checkpoint['state']
+
+    def save(self, model, optimizer, state):
+        """Write a checkpoint for state['epoch'] if one is due, and drop the old ones."""
+        if not self.save_enabled or state['epoch'] % self.every != 0:
+            return
+
+        checkpoint = {
+            'model': getattr(model, 'module', model).state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'rng': {
+                'torch': torch.get_rng_state(),
+                'numpy': np.random.get_state(),
+                'python': random.getstate(),
+            },
+            'state': state,
+        }
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        path = os.path.join(self.checkpoint_dir, _PATTERN.format(state['epoch']))
+
+        # Write to a temporary file first, so a crash while saving never corrupts the newest checkpoint
+        tmp_path = path + '.tmp'
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+
+        for old_path in self._paths()[:-self.keep]:
+            os.remove(old_path)
@@ -0,0 +1,250 @@
+import argparse
+import struct
+
+import numpy as np
+import torch
+import torch.utils.data
+
+# Binary training set: the same 'label, length, review[pad]' rows as train.csv, stored so the
+# file can be memory-mapped instead of parsed.
+#
+#   magic (8 bytes) | count, pad, token size (uint64 each) | labels | lengths | tokens
+#
+# Labels are float32, lengths int32 and the tokens a (count, pad) matrix of uint16 ids (uint32
+# if the vocabulary does not fit into 16 bits). Every section starts 64-byte aligned.
+
+DATASET_NAME = 'train.bin'
+
+_MAGIC = b'REVIEWS1'
+_HEADER = struct.Struct('<8sQQQ')
+_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _layout(count, pad, token_size):
+    """Offsets of the labels, lengths and tokens sections and the total file size."""
+    labels_offset = _align(_HEADER.size)
+    lengths_offset = _align(labels_offset + 4 * count)
+    tokens_offset = _align(lengths_offset + 4 * count)
+    return labels_offset, lengths_offset, tokens_offset, tokens_offset + token_size * count * pad
+
+
+def write_dataset(path, labels, lengths, reviews):
+    """Write labels, review lengths and the (count, pad) matrix of padded reviews to path."""
+    labels = np.asarray(labels, dtype=np.float32).reshape(-1)
+    lengths = np.asarray(lengths, dtype=np.int32).reshape(-1)
+    reviews = np.asarray(reviews)
+    count, pad = reviews.shape
+
+    if not len(labels) == len(lengths) == count:
+        raise ValueError('labels, lengths and reviews must have the same number of rows.')
+
+    token_dtype = np.uint16 if count == 0 or reviews.max() <= np.iinfo(np.uint16).max else np.uint32
+    token_size = np.dtype(token_dtype).itemsize
+    labels_offset, lengths_offset, tokens_offset, size = _layout(count, pad, token_size)
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, count, pad, token_size))
+        f.seek(labels_offset)
+        f.write(labels.tobytes())
+        f.seek(lengths_offset)
+        f.write(lengths.tobytes())
+        f.seek(tokens_offset)
+        f.write(np.ascontiguousarray(reviews, dtype=token_dtype).tobytes())
+        f.truncate(size)
+
+
+def csv_to_dataset(csv_path, path):
+    """Convert a train.csv ('label, length, review[pad]' rows) into the binary format."""
+    import pandas as pd
+
+    data = pd.read_csv(csv_path, header=None, names=None).values
+    write_dataset(path, data[:, 0], data[:, 1], data[:, 2:])
+
+
+class ReviewDataset(torch.utils.data.Dataset):
+    """
+    Memory-mapped view of a binary training set. Nothing is read up front: indexing with a list
+    of indices (e.g. from a BatchSampler) reads just those rows and returns them as a batch of
+    'len, review[pad]' rows plus their labels.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, count, pad, token_size = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError('{} is not a review dataset.'.format(path))
+
+        labels_offset, lengths_offset, tokens_offset, _ = _layout(count, pad, token_size)
+        token_dtype = {2: np.uint16, 4: np.uint32}[token_size]
+
+        self.path = path
+        self.pad = pad
+        if count == 0:
+            self.labels = np.zeros(0, dtype=np.float32)
+            self.lengths = np.zeros(0, dtype=np.int32)
+            self.tokens = np.zeros((0, pad), dtype=token_dtype)
+            return
+        self.labels = np.memmap(path, dtype=np.float32, mode='r', offset=labels_offset, shape=(count,))
+        self.lengths = np.memmap(path, dtype=np.int32, mode='r', offset=lengths_offset, shape=(count,))
+        self.tokens = np.memmap(path, dtype=token_dtype, mode='r', offset=tokens_offset, shape=(count, pad))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        single = np.ndim(idx) == 0
+        idx = np.atleast_1d(np.asarray(idx, dtype=np.int64))
+
+        rows = np.empty((len(idx), self.pad + 1), dtype=np.int64)
+        rows[:, 0] = self.lengths[idx]
+        rows[:, 1:] = self.tokens[idx]
+        labels = np.array(self.labels[idx], dtype=np.float32)
+
+        if single:
+            return torch.from_numpy(rows[0]), torch.tensor(labels[0])
+        return torch.from_numpy(rows), torch.from_numpy(labels)
+
+
+class Subset(torch.utils.data.Dataset):
+    """The rows `indices` of a dataset, which can be indexed with a list of indices as well."""
+
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        return self.dataset[self.indices[idx]]
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields batches of indices of reviews with similar lengths, so that little work is wasted on
+    padding. Every epoch the reviews are shuffled and cut into buckets of `bucket_batches`
+    batches; each bucket is sorted by length and split into batches, and the batches of all
+    buckets are shuffled again. Call set_epoch before every epoch to get a new order.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_batches=50, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self, indices, rng):
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = []
+        for start in range(0, len(indices), bucket_size):
+            bucket = indices[start:start + bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[idx:idx + self.batch_size] for idx in range(0, len(bucket), self.batch_size))
+        return [batches[idx] for idx in rng.permutation(len(batches))]
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        for batch in self._batches(rng.permutation(len(self.lengths)), rng):
+            yield batch.tolist()
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class ShardedBatchSampler(torch.utils.data.Sampler):
+    """
+    Splits the batches of another batch sampler between the processes of a data-parallel run:
+    process `rank` gets every `num_replicas`-th batch. The wrapped sampler must produce the same
+    batches in every process (BucketBatchSampler does for the same seed and epoch). Batches from
+    the start are repeated so that all processes run the same number of steps.
+    """
+
+    def __init__(self, batch_sampler, num_replicas, rank):
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def set_epoch(self, epoch):
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        batches = list(self.batch_sampler)
+        padding = len(self) * self.num_replicas - len(batches)
+        batches += (batches * (padding // max(len(batches), 1) + 1))[:padding]
+        return iter(batches[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return (len(self.batch_sampler) + self.num_replicas - 1) // self.num_replicas
+
+
+class BatchLoader(object):
+    """
+    Reads whole batches from the dataset with one index lookup each, in the order of a batch
+    sampler. This is what a DataLoader with batch_size=None does, which older versions of torch
+    (like the 0.4 SageMaker container) do not support.
+    """
+
+    def __init__(self, dataset, sampler):
+        self.dataset = dataset
+        self.sampler = sampler
+
+    def __iter__(self):
+        for batch in self.sampler:
+            yield self.dataset[batch]
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def batch_loader(dataset, batch_size, lengths=None, bucket_batches=0, seed=0, num_replicas=1, rank=0):
+    """
+    BatchLoader over the dataset. Batches are taken in order, or from a BucketBatchSampler if
+    the review lengths and bucket_batches > 0 are given. With num_replicas > 1 only the share of
+    process `rank` is loaded.
+    """
+    if lengths is not None and bucket_batches > 0:
+        sampler = BucketBatchSampler(lengths, batch_size, bucket_batches, seed)
+    else:
+        sampler = torch.utils.data.BatchSampler(torch.utils.data.SequentialSampler(dataset), batch_size, drop_last=False)
+    if num_replicas > 1:
+        sampler = ShardedBatchSampler(sampler, num_replicas, rank)
+    return BatchLoader(dataset, sampler)
+
+
+def choose_pad(lengths, percentile, max_pad):
+    """Pad length that covers `percentile` percent of the review lengths, between 1 and max_pad."""
+    if len(lengths) == 0:
+        return max_pad
+    pad = int(np.ceil(np.percentile(lengths, percentile)))
+    return min(max(pad, 1), max_pad)
+
+
+def trim_batch(batch_X, pad=None):
+    """
+    Drop the padding columns that no review of a 'len, review[pad]' batch reaches. With `pad`,
+    longer reviews are cut to their first `pad` words as well, like encode_batch does.
+    """
+    if pad is not None and batch_X.shape[1] > pad + 1:
+        batch_X = batch_X[:, :pad + 1].clone()
+        batch_X[:, 0].clamp_(max=pad)
+    max_length = max(int(batch_X[:, 0].max()), 1) if len(batch_X) else 1
+    return batch_X[:, :max_length + 1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert train.csv into the binary training set format.')
+    parser.add_argument('csv_path', help='train.csv with label, length, review[pad] rows')
+    parser.add_argument('path', nargs='?', default=DATASET_NAME,
+                        help='binary dataset to write (default: {})'.format(DATASET_NAME))
+    args = parser.parse_args()
+
+    csv_to_dataset(args.csv_path, args.path)
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 
 class LSTMClassifier(nn.Module):
@@ -5,19 +6,25 @@ class LSTMClassifier(nn.Module):
     This is the simple RNN model we will be using to perform Sentiment Analysis.
     """
 
-    def __init__(self, embedding_dim, hidden_dim, vocab_size):
+    def __init__(self, embedding_dim, hidden_dim, vocab_size, packed=True, sparse=False):
         """
         Initialize the model by settingg up the various layers.
         """
         super(LSTMClassifier, self).__init__()
 
-        self.embedding = nn.Embedding(vocab_size, embedding_dim, padding_idx=0)
+        # With sparse set, backward only produces gradients for the rows of the words in the
+        # batch instead of the whole table (train these with optim.SparseAdam)
+        self.embedding = nn.Embedding(vocab_size, embedding_dim, padding_idx=0, sparse=sparse)
         self.lstm = nn.LSTM(embedding_dim, hidden_dim)
         self.dense = nn.Linear(in_features=hidden_dim, out_features=1)
         self.sig = nn.Sigmoid()
         
         self.word_dict = None
 
+        # When set, the LSTM only runs over the real words of each review instead of all
+        # padded timesteps (see _forward_packed)
+        self.packed = packed
+
     def forward(self, x):
         """
         Perform a forward pass of our model on some input.
@@ -25,8 +32,31 @@ class LSTMClassifier(nn.Module):
         x = x.t()
         lengths = x[0,:]
         reviews = x[1:,:]
+
+        # An empty review has no last word to stop at, so those batches take the padded path
+        if self.packed and bool((lengths > 0).all()):
+            out = self._forward_packed(reviews, lengths)
+        else:
+            embeds = self.embedding(reviews)
+            lstm_out, _ = self.lstm(embeds)
+            out = self.dense(lstm_out)
+            out = out[lengths - 1, range(len(lengths))]
+        return self.sig(out.squeeze())
+
+    def _forward_packed(self, reviews, lengths):
+        """
+        Run the LSTM over the first `lengths` words of each review only. The LSTM is causal, so
+        its final hidden state for a packed review equals the padded output at `lengths - 1`.
+        """
+        # Sort by length (longest first) so the padded tail past the longest review is dropped
+        # and each shorter review leaves the batch as soon as it ends
+        sorted_lengths, order = torch.sort(lengths, descending=True)
+        reviews = reviews[:int(sorted_lengths[0]), order]
+
         embeds = self.embedding(reviews)
-        lstm_out, _ = self.lstm(embeds)
-        out = self.dense(lstm_out)
-        out = out[lengths - 1, range(len(lengths))]
-        return self.sig(out.squeeze())
\ No newline at end of file
+        packed = nn.utils.rnn.pack_padded_sequence(embeds, sorted_lengths.cpu())
+        _, (hidden, _) = self.lstm(packed)
+        out = self.dense(hidden[-1])
+
+        # Put the reviews back into the order they came in
+        return out[torch.argsort(order)]
@@ -0,0 +1,87 @@
+import os
+import resource
+import sys
+import time
+
+import torch
+import torch.distributed as dist
+
+# Training instrumentation: a per-epoch breakdown of where the time goes (waiting for the next
+# batch vs running the model) and an optional torch.profiler window that traces a few steps.
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+class EpochTimer(object):
+    """
+    Splits the time of an epoch into data loading (waiting for the loader to hand over the next
+    batch) and compute (forward, backward and optimizer step), and counts the samples.
+    """
+
+    def __init__(self):
+        self.data_time = 0.0
+        self.compute_time = 0.0
+        self.samples = 0
+        self.start = self._last = time.perf_counter()
+
+    def batch_loaded(self):
+        now = time.perf_counter()
+        self.data_time += now - self._last
+        self._last = now
+
+    def step_done(self, samples):
+        now = time.perf_counter()
+        self.compute_time += now - self._last
+        self._last = now
+        self.samples += samples
+
+    def reduce(self):
+        """
+        Sum the samples over all processes of a data-parallel run, so that the summary reports
+        the throughput of the whole run. Every process has to call this.
+        """
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            samples = torch.tensor([self.samples], dtype=torch.int64)
+            dist.all_reduce(samples)
+            self.samples = int(samples.item())
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        return "{:.1f} samples/s, {:.1f}s data loading, {:.1f}s compute, peak RSS {:.0f} MB".format(
+            self.samples / elapsed if elapsed > 0 else 0.0, self.data_time, self.compute_time, peak_rss_mb())
+
+
+def start_profiler(steps, profile_dir, rank=0):
+    """
+    Start a torch.profiler window over `steps` training steps, after skipping one step and
+    warming up on another. When the window closes, the Chrome trace is written to
+    profile_dir/trace-rank<rank>.json (open it in chrome://tracing or Perfetto) and the most
+    expensive operators are printed. Returns None if steps is 0.
+    """
+    if steps <= 0:
+        return None
+
+    os.makedirs(profile_dir, exist_ok=True)
+    trace_path = os.path.join(profile_dir, 'trace-rank{}.json'.format(rank))
+
+    def trace_ready(profiler):
+        profiler.export_chrome_trace(trace_path)
+        print("Wrote profiler trace of {} steps to {}.".format(steps, trace_path))
+        print(profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=1, warmup=1, active=steps, repeat=1),
+        on_trace_ready=trace_ready,
+        record_shapes=True)
+    profiler.start()
+    return profiler
@@ -4,58 +4,167 @@ import os
 import pickle
 import sys
 import sagemaker_containers
+import numpy as np
 import pandas as pd
 import torch
+import torch.distributed as dist
 import torch.optim as optim
 import torch.utils.data
+from torch.nn.parallel import DistributedDataParallel
 
 from model import LSTMClassifier
+from artifact import ARTIFACT_NAME, load_artifact, save_artifact
+from checkpoint import Checkpointer
+from dataset import DATASET_NAME, ReviewDataset, Subset, batch_loader, choose_pad, trim_batch
+from profiling import EpochTimer, start_profiler
 
-def model_fn(model_dir):
-    """Load the PyTorch model from the `model_dir` directory."""
-    print("Loading model.")
+class MultiOptimizer(object):
+    """
+    Several optimizers stepped as one, e.g. SparseAdam for a sparse embedding and Adam for the
+    dense parameters. The state_dict holds the state of every optimizer.
+    """
+
+    def __init__(self, *optimizers):
+        self.optimizers = optimizers
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+def make_optimizer(model, sparse_embedding=False):
+    """Adam for all parameters, or SparseAdam for a sparse embedding plus Adam for the rest."""
+    if not sparse_embedding:
+        return optim.Adam(model.parameters())
 
+    embedding_params = list(model.embedding.parameters())
+    dense_params = [param for name, param in model.named_parameters() if not name.startswith('embedding.')]
+    return MultiOptimizer(optim.SparseAdam(embedding_params), optim.Adam(dense_params))
+
+
+def _load_model_files(model_dir):
+    """Read model_info, the model parameters and the word_dict from their three separate files."""
     # First, load the parameters used to create the model.
     model_info = {}
     model_info_path = os.path.join(model_dir, 'model_info.pth')
     with open(model_info_path, 'rb') as f:
         model_info = torch.load(f)
 
-    print("model_info: {}".format(model_info))
-
-    # Determine the device and construct the model.
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = LSTMClassifier(model_info['embedding_dim'], model_info['hidden_dim'], model_info['vocab_size'])
-
     # Load the stored model parameters.
     model_path = os.path.join(model_dir, 'model.pth')
     with open(model_path, 'rb') as f:
-        model.load_state_dict(torch.load(f))
+        state_dict = torch.load(f)
 
     # Load the saved word_dict.
     word_dict_path = os.path.join(model_dir, 'word_dict.pkl')
     with open(word_dict_path, 'rb') as f:
-        model.word_dict = pickle.load(f)
+        word_dict = pickle.load(f)
 
-    model.to(device).eval()
+    return model_info, state_dict, word_dict
 
-    print("Done loading model.")
-    return model
+def model_fn(model_dir):
+    """Load the PyTorch model from the `model_dir` directory."""
+    print("Loading model.")
+
+    # Prefer the single memory-mapped artifact, if training wrote one.
+    artifact_path = os.path.join(model_dir, ARTIFACT_NAME)
+    if os.path.exists(artifact_path):
+        model_info, state_dict, word_dict = load_artifact(artifact_path)
+    else:
+        model_info, state_dict, word_dict = _load_model_files(model_dir)
+
+    print("model_info: {}".format(model_info))
+
+    # Determine the device and construct the model.
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = LSTMClassifier(model_info['embedding_dim'], model_info['hidden_dim'], model_info['vocab_size'])
 
-def _get_train_data_loader(batch_size, training_dir):
-    print("Get train data loader.")
+    # Use the (possibly memory-mapped) tensors as they are instead of copying them into the model.
+    try:
+        model.load_state_dict(state_dict, assign=True)
+    except TypeError:
+        model.load_state_dict(state_dict)
 
-    train_data = pd.read_csv(os.path.join(training_dir, "train.csv"), header=None, names=None)
+    model.word_dict = word_dict
+    model.pad = model_info.get('pad', 500)
 
-    train_y = torch.from_numpy(train_data[[0]].values).float().squeeze()
-    train_X = torch.from_numpy(train_data.drop([0], axis=1).values).long()
+    model.to(device).eval()
 
-    train_ds = torch.utils.data.TensorDataset(train_X, train_y)
+    print("Done loading model.")
+    return model
 
-    return torch.utils.data.DataLoader(train_ds, batch_size=batch_size)
+def _get_train_data_loader(batch_size, training_dir, bucket_batches=0, seed=0, num_replicas=1, rank=0,
+                           validation_split=0.0, pad_percentile=100.0):
+    """
+    Return the training data loader, one for the held out reviews if validation_split > 0 (None
+    otherwise) and the pad length that covers pad_percentile percent of the training reviews.
+    Only the first process of a data-parallel run (rank 0) prints.
+    """
+    if rank == 0:
+        print("Get train data loader.")
+
+    # Prefer the memory-mapped binary training set, batches are then read from disk as needed.
+    dataset_path = os.path.join(training_dir, DATASET_NAME)
+    if os.path.exists(dataset_path):
+        train_ds = ReviewDataset(dataset_path)
+        lengths = np.asarray(train_ds.lengths)
+    else:
+        train_data = pd.read_csv(os.path.join(training_dir, "train.csv"), header=None, names=None)
+
+        train_y = torch.from_numpy(train_data[[0]].values).float().squeeze()
+        train_X = torch.from_numpy(train_data.drop([0], axis=1).values).long()
+
+        train_ds = torch.utils.data.TensorDataset(train_X, train_y)
+        lengths = train_X[:, 0].numpy()
+
+    # Hold out a random share of the reviews, the same one in every process of a data-parallel
+    # run. Every process validates on all of it, so they all take the same early stopping decision.
+    validation_loader = None
+    if validation_split > 0:
+        order = np.random.RandomState(seed).permutation(len(train_ds))
+        split = int(round(len(train_ds) * validation_split))
+        validation_loader = batch_loader(Subset(train_ds, np.sort(order[:split])), batch_size)
+        train_indices = np.sort(order[split:])
+        train_ds, lengths = Subset(train_ds, train_indices), lengths[train_indices]
+
+    # Every process sees the same lengths, so they all choose the same pad length
+    max_pad = train_ds[[0]][0].shape[1] - 1 if len(train_ds) else 500
+    pad = choose_pad(lengths, pad_percentile, max_pad)
+    truncated = float(np.mean(lengths > pad)) if len(lengths) else 0.0
+    if rank == 0:
+        print("Pad length {} ({}th percentile), {:.1%} of the training reviews are cut.".format(pad, pad_percentile, truncated))
+
+    train_loader = batch_loader(train_ds, batch_size, lengths, bucket_batches, seed, num_replicas, rank)
+    return train_loader, validation_loader, pad
+
+
+def evaluate(model, data_loader, loss_fn, device, pad=None):
+    """Average loss of the model over all reviews of data_loader, cut to pad words."""
+    model.eval()
+    total_loss = 0.0
+    count = 0
+    with torch.no_grad():
+        for batch_X, batch_y in data_loader:
+            batch_X = trim_batch(batch_X, pad).to(device)
+            batch_y = batch_y.to(device)
+            total_loss += loss_fn(model(batch_X), batch_y).item() * len(batch_y)
+            count += len(batch_y)
+    return total_loss / max(count, 1)
 
 
-def train(model, train_loader, epochs, optimizer, loss_fn, device):
+def train(model, train_loader, epochs, optimizer, loss_fn, device, verbose=True,
+          validation_loader=None, patience=0, checkpointer=None, profiler=None, pad=None):
     """
     This is the training method that is called by the PyTorch training script. The parameters
     passed are as follows:
@@ -65,15 +174,39 @@ def train(model, train_loader, epochs, optimizer, loss_fn, device):
     optimizer    - The optimizer to use during training.
     loss_fn      - The loss function used for training.
     device       - Where the model and data should be loaded (gpu or cpu).
+    verbose      - Whether to print the loss (only the first process of a data-parallel run does).
+    validation_loader - Held out reviews to compute the validation loss on after every epoch.
+    patience     - Stop after this many epochs without a better validation loss (0 never stops).
+    checkpointer - Saves a checkpoint after every epoch and resumes from the newest one.
+    profiler     - A running torch.profiler, stepped after every batch.
+    pad          - Cut the reviews to this many words.
+
+    With a validation_loader, the model ends up with the parameters of its best epoch.
     """
-    
+    state = {'epoch': 0, 'best_loss': None, 'best_model': None, 'bad_epochs': 0, 'stopped': False}
+    if checkpointer is not None:
+        state = checkpointer.restore(model, optimizer) or state
+
     # TODO: Paste the train() method developed in the notebook here.
-    for epoch in range(1, epochs + 1):
+    for epoch in range(state['epoch'] + 1, epochs + 1):
+        if state['stopped']:
+            break
+
         model.train()
         total_loss = 0
+
+        # A bucketing sampler shuffles differently every epoch
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(epoch)
+
+        timer = EpochTimer()
         for batch in train_loader:         
+            timer.batch_loaded()
             batch_X, batch_y = batch
             
+            # Only run the model over as many steps as the longest review in the batch needs
+            batch_X = trim_batch(batch_X, pad)
+
             batch_X = batch_X.to(device)
             batch_y = batch_y.to(device)
             
@@ -90,8 +223,147 @@ def train(model, train_loader, epochs, optimizer, loss_fn, device):
             
             # update total loss
             total_loss += loss.data.item()
-            
-        print("Epoch: {}, BCELoss: {}".format(epoch, total_loss / len(train_loader)))
+
+            timer.step_done(len(batch_y))
+            if profiler is not None:
+                profiler.step()
+
+        timer.reduce()
+        if verbose:
+            print("Epoch: {}, BCELoss: {}".format(epoch, total_loss / len(train_loader)))
+            print("Epoch: {}, {}".format(epoch, timer.summary()))
+
+        if validation_loader is not None:
+            validation_loss = evaluate(model, validation_loader, loss_fn, device, pad)
+            if verbose:
+                print("Epoch: {}, Validation BCELoss: {}".format(epoch, validation_loss))
+
+            if state['best_loss'] is None or validation_loss < state['best_loss']:
+                state['best_loss'] = validation_loss
+                state['best_model'] = {name: value.detach().cpu().clone()
+                                       for name, value in getattr(model, 'module', model).state_dict().items()}
+                state['bad_epochs'] = 0
+            else:
+                state['bad_epochs'] += 1
+            state['stopped'] = patience > 0 and state['bad_epochs'] >= patience
+
+        state['epoch'] = epoch
+        if checkpointer is not None:
+            checkpointer.save(model, optimizer, state)
+
+        if state['stopped'] and verbose:
+            print("No improvement for {} epochs, stopping early.".format(patience))
+
+    if state['best_model'] is not None:
+        if verbose:
+            print("Restoring the best model, validation BCELoss: {}".format(state['best_loss']))
+        getattr(model, 'module', model).load_state_dict(state['best_model'])
+
+
+def _init_distributed(args, local_rank):
+    """
+    Join the gloo process group of a data-parallel run with args.workers processes on each of
+    args.hosts. Returns the rank of this process and the number of processes.
+    """
+    world_size = len(args.hosts) * args.workers
+    if world_size == 1:
+        return 0, 1
+
+    rank = args.hosts.index(args.current_host) * args.workers + local_rank
+    os.environ.setdefault('MASTER_ADDR', args.hosts[0] if len(args.hosts) > 1 else '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(args.master_port))
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    # Share the cores of the host between its processes instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+
+    return rank, world_size
+
+
+def _save_model(model, args, pad):
+    # Save the parameters used to construct the model
+    model_info_path = os.path.join(args.model_dir, 'model_info.pth')
+    with open(model_info_path, 'wb') as f:
+        model_info = {
+            'embedding_dim': args.embedding_dim,
+            'hidden_dim': args.hidden_dim,
+            'vocab_size': args.vocab_size,
+            'pad': pad,
+        }
+        torch.save(model_info, f)
+
+    # Save the word_dict
+    word_dict_path = os.path.join(args.model_dir, 'word_dict.pkl')
+    with open(word_dict_path, 'wb') as f:
+        pickle.dump(model.word_dict, f)
+
+    # Save the model parameters
+    model_path = os.path.join(args.model_dir, 'model.pth')
+    with open(model_path, 'wb') as f:
+        torch.save(model.cpu().state_dict(), f)
+
+    # Save everything once more as a single artifact, which model_fn prefers when it is present
+    artifact_path = os.path.join(args.model_dir, ARTIFACT_NAME)
+    if args.single_artifact:
+        save_artifact(artifact_path, model_info, model.state_dict(), model.word_dict)
+    elif os.path.exists(artifact_path):
+        # An artifact left by an earlier run would be loaded instead of the files written above
+        os.remove(artifact_path)
+
+
+def main(local_rank, args):
+    """Train the model in one process; local_rank is the index of the process on this host."""
+    rank, world_size = _init_distributed(args, local_rank)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if rank == 0:
+        print("Using device {}, {} training process(es).".format(device, world_size))
+
+    torch.manual_seed(args.seed)
+
+    # Load the training data, every process gets its own share of the batches.
+    train_loader, validation_loader, pad = _get_train_data_loader(
+        args.batch_size, args.data_dir, args.bucket_batches, args.seed, world_size, rank,
+        args.validation_split, args.pad_percentile)
+
+    # Build the model.
+    model = LSTMClassifier(args.embedding_dim, args.hidden_dim, args.vocab_size,
+                           sparse=bool(args.sparse_embedding)).to(device)
+
+    with open(os.path.join(args.data_dir, "word_dict.pkl"), "rb") as f:
+        model.word_dict = pickle.load(f)
+
+    if rank == 0:
+        print("Model loaded with embedding_dim {}, hidden_dim {}, vocab_size {}.".format(
+            args.embedding_dim, args.hidden_dim, args.vocab_size
+        ))
+
+    # In a data-parallel run the gradients are averaged across all processes after every backward
+    # pass, so every process ends up with the same parameters.
+    train_model = model if world_size == 1 else DistributedDataParallel(model)
+
+    # Train the model.
+    optimizer = make_optimizer(model, args.sparse_embedding)
+    loss_fn = torch.nn.BCELoss()
+
+    # Only rank 0 writes checkpoints, every process resumes from the newest one rank 0 finds
+    checkpointer = Checkpointer(args.checkpoint_dir, args.checkpoint_every, save=rank == 0)
+
+    profiler = start_profiler(args.profile_steps, args.profile_dir, rank)
+
+    train(train_model, train_loader, args.epochs, optimizer, loss_fn, device, verbose=rank == 0,
+          validation_loader=validation_loader, patience=args.patience, checkpointer=checkpointer,
+          profiler=profiler, pad=pad)
+
+    if profiler is not None:
+        profiler.stop()
+
+    if world_size > 1:
+        dist.destroy_process_group()
+
+    # Only the first process saves the model, the others hold identical copies.
+    if rank == 0:
+        _save_model(model, args, pad)
 
 
 if __name__ == '__main__':
@@ -107,6 +379,22 @@ if __name__ == '__main__':
                         help='number of epochs to train (default: 10)')
     parser.add_argument('--seed', type=int, default=1, metavar='S',
                         help='random seed (default: 1)')
+    parser.add_argument('--bucket-batches', type=int, default=50, metavar='N',
+                        help='batches per bucket of reviews with similar lengths, 0 disables bucketing (default: 50)')
+    parser.add_argument('--validation-split', type=float, default=0.0, metavar='F',
+                        help='fraction of the training data held out to compute a validation loss (default: 0.0)')
+    parser.add_argument('--patience', type=int, default=0, metavar='N',
+                        help='epochs without a better validation loss before training stops, 0 never stops (default: 0)')
+
+    parser.add_argument('--pad-percentile', type=float, default=100.0, metavar='P',
+                        help='cut reviews to the length of the P-th percentile of the training reviews, '
+                             'saved as pad in model_info (default: 100.0)')
+
+    # Checkpoint Parameters
+    parser.add_argument('--checkpoint-dir', type=str, default='/opt/ml/checkpoints',
+                        help='directory to write checkpoints to and resume from (default: /opt/ml/checkpoints)')
+    parser.add_argument('--checkpoint-every', type=int, default=1, metavar='N',
+                        help='save a checkpoint every N epochs, 0 disables checkpoints (default: 1)')
 
     # Model Parameters
     parser.add_argument('--embedding_dim', type=int, default=32, metavar='N',
@@ -115,6 +403,24 @@ if __name__ == '__main__':
                         help='size of the hidden dimension (default: 100)')
     parser.add_argument('--vocab_size', type=int, default=5000, metavar='N',
                         help='size of the vocabulary (default: 5000)')
+    parser.add_argument('--sparse-embedding', type=int, default=0, metavar='0|1',
+                        help='set to 1 for sparse embedding gradients, trained with SparseAdam (default: 0)')
+
+    # Output Parameters
+    parser.add_argument('--single-artifact', type=int, default=0, metavar='0|1',
+                        help='set to 1 to also write {}, a single memory-mapped file (default: 0)'.format(ARTIFACT_NAME))
+
+    # Profiling Parameters
+    parser.add_argument('--profile-steps', type=int, default=0, metavar='N',
+                        help='trace N training steps with torch.profiler, 0 disables profiling (default: 0)')
+    parser.add_argument('--profile-dir', type=str, default=os.environ.get('SM_OUTPUT_DATA_DIR', 'profile'),
+                        help='directory for the Chrome trace of the profiled steps (default: $SM_OUTPUT_DATA_DIR)')
+
+    # Data-Parallel Parameters
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='training processes per host, gradients are averaged over all of them (default: 1)')
+    parser.add_argument('--master-port', type=int, default=29500, metavar='N',
+                        help='port of the first host used to set up data-parallel training (default: 29500)')
 
     # SageMaker Parameters
     parser.add_argument('--hosts', type=list, default=json.loads(os.environ['SM_HOSTS']))
@@ -125,46 +431,7 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print("Using device {}.".format(device))
-
-    torch.manual_seed(args.seed)
-
-    # Load the training data.
-    train_loader = _get_train_data_loader(args.batch_size, args.data_dir)
-
-    # Build the model.
-    model = LSTMClassifier(args.embedding_dim, args.hidden_dim, args.vocab_size).to(device)
-
-    with open(os.path.join(args.data_dir, "word_dict.pkl"), "rb") as f:
-        model.word_dict = pickle.load(f)
-
-    print("Model loaded with embedding_dim {}, hidden_dim {}, vocab_size {}.".format(
-        args.embedding_dim, args.hidden_dim, args.vocab_size
-    ))
-
-    # Train the model.
-    optimizer = optim.Adam(model.parameters())
-    loss_fn = torch.nn.BCELoss()
-
-    train(model, train_loader, args.epochs, optimizer, loss_fn, device)
-
-    # Save the parameters used to construct the model
-    model_info_path = os.path.join(args.model_dir, 'model_info.pth')
-    with open(model_info_path, 'wb') as f:
-        model_info = {
-            'embedding_dim': args.embedding_dim,
-            'hidden_dim': args.hidden_dim,
-            'vocab_size': args.vocab_size,
-        }
-        torch.save(model_info, f)
-
-	# Save the word_dict
-    word_dict_path = os.path.join(args.model_dir, 'word_dict.pkl')
-    with open(word_dict_path, 'wb') as f:
-        pickle.dump(model.word_dict, f)
-
-	# Save the model parameters
-    model_path = os.path.join(args.model_dir, 'model.pth')
-    with open(model_path, 'wb') as f:
-        torch.save(model.cpu().state_dict(), f)
+    if args.workers > 1:
+        torch.multiprocessing.spawn(main, args=(args,), nprocs=args.workers)
+    else:
+        main(0, args)
@@ -0,0 +1,67 @@
+import heapq
+import itertools
+import os
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Streaming vocabulary builder for the sentiment model. The reviews are read as a stream of
+# token lists, counted shard by shard in worker processes and merged, so only the word counts
+# (not the corpus) are ever held in memory.
+
+
+def _count_shard(shard):
+    counts = Counter()
+    for words in shard:
+        counts.update(words)
+    return counts
+
+
+def _shards(data, shard_size):
+    data = iter(data)
+    while True:
+        shard = list(itertools.islice(data, shard_size))
+        if not shard:
+            return
+        yield shard
+
+
+def count_words(data, workers=None, shard_size=1000):
+    """
+    Count how often every word appears in `data`, an iterable (e.g. a generator) of token lists.
+    Shards of `shard_size` reviews are counted in `workers` processes; at most two shards per
+    worker are read ahead, so memory does not grow with the size of the corpus.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    counts = Counter()
+
+    if workers <= 1:
+        for shard in _shards(data, shard_size):
+            counts.update(_count_shard(shard))
+        return counts
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for shard in _shards(data, shard_size):
+            pending.append(executor.submit(_count_shard, shard))
+            if len(pending) >= 2 * workers:
+                counts.update(pending.popleft().result())
+        while pending:
+            counts.update(pending.popleft().result())
+
+    return counts
+
+
+def top_words(counts, vocab_size=5000):
+    """
+    Map the vocab_size - 2 most frequent words to the ids 2, 3, ... (0 and 1 are reserved for
+    'no word' and 'infrequent'). Ties are broken like sorting (count, word) pairs in reverse.
+    """
+    most_common = heapq.nlargest(vocab_size - 2, counts.items(), key=lambda item: (item[1], item[0]))
+    return {word: idx + 2 for idx, (word, _) in enumerate(most_common)}
+
+
+def build_dict(data, vocab_size=5000, workers=None, shard_size=1000):
+    """Construct and return a dictionary mapping each of the most frequently appearing words to a unique integer."""
+    counts = count_words(data, workers, shard_size)
+    print('{} unique words found'.format(len(counts)))
+    return top_words(counts, vocab_size)
@@ -1,4 +1,9 @@
+import mmap
+import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import operator 
 
@@ -10,40 +15,42 @@ def create_datatype(df, train_value, test_value, datatype_var, compare_dfcolumn,
                     sampling_number, sampling_seed):
     # Subsets dataframe by condition relating to statement built from:
     # 'compare_dfcolumn' 'operator_of_compare' 'value_of_compare'
-    df_subset = df[operator_of_compare(df[compare_dfcolumn], value_of_compare)]
-    df_subset = df_subset.drop(columns = [datatype_var])
+    in_subset = np.asarray(operator_of_compare(df[compare_dfcolumn], value_of_compare), dtype=bool)
+    df_subset = df.loc[in_subset, ['Task', compare_dfcolumn]]
     
-    # Prints counts by task and compare_dfcolumn for subset df
-    #print("\nCounts by Task & " + compare_dfcolumn + ":\n", df_subset.groupby(['Task', compare_dfcolumn]).size().reset_index(name="Counts") )
+    # Performs stratified random sample of subset dataframe, by task and compare_dfcolumn
+    is_test = stratified_sample_mask(df_subset, ['Task', compare_dfcolumn], sampling_number, sampling_seed)
     
-    # Sets all datatype to value for training for df_subset
-    df_subset.loc[:, datatype_var] = train_value
-    
-    # Performs stratified random sample of subset dataframe to create new df with subset values 
-    df_sampled = df_subset.groupby(['Task', compare_dfcolumn], group_keys=False).apply(lambda x: x.sample(min(len(x), sampling_number), random_state = sampling_seed))
-    df_sampled = df_sampled.drop(columns = [datatype_var])
-    # Sets all datatype to value for test_value for df_sampled
-    df_sampled.loc[:, datatype_var] = test_value
-    
-    # Prints counts by compare_dfcolumn for selected sample
-    #print("\nCounts by "+ compare_dfcolumn + ":\n", df_sampled.groupby([compare_dfcolumn]).size().reset_index(name="Counts") )
-    #print("\nSampled DF:\n",df_sampled)
-    
-    # Labels all datatype_var column as train_value which will be overwritten to 
-    # test_value in next for loop for all test cases chosen with stratified sample
-    for index in df_sampled.index: 
-        # Labels all datatype_var columns with test_value for straified test sample
-        df_subset.loc[index, datatype_var] = test_value
-
-    #print("\nSubset DF:\n",df_subset)
-    # Adds test_value and train_value for all relevant data in main dataframe
-    for index in df_subset.index:
-        # Labels all datatype_var columns in df with train_value/test_value based upon 
-        # stratified test sample and subset of df
-        df.loc[index, datatype_var] = df_subset.loc[index, datatype_var]
+    # Labels the sampled rows of the subset with test_value and all others with train_value
+    df.loc[in_subset, datatype_var] = np.where(is_test, test_value, train_value)
 
     # returns nothing because dataframe df already altered 
     
+def stratified_sample_mask(df, by, sampling_number, sampling_seed):
+    '''Boolean mask of a stratified random sample of `sampling_number` rows (or all rows of smaller
+       groups) from every group of `df` grouped by the columns `by`. Selects the same rows as
+       df.groupby(by).apply(lambda x: x.sample(min(len(x), sampling_number), random_state=sampling_seed))
+       without copying any group: sample with an int seed keeps the rows at the first positions
+       of RandomState(seed).permutation(len(group)), so each row is ranked by its position in its
+       group once per distinct group size. Rows with a missing group key are never sampled.'''
+    groups = df.groupby(by, sort=False)
+    group_ids = groups.ngroup().values
+    positions = groups.cumcount().values
+    valid = group_ids >= 0
+
+    sizes = np.zeros(len(df), dtype=np.int64)
+    sizes[valid] = np.bincount(group_ids[valid])[group_ids[valid]]
+
+    mask = np.zeros(len(df), dtype=bool)
+    for size in np.unique(sizes[valid]):
+        rows = valid & (sizes == size)
+        # rank[p] is the place of group position p in the permutation
+        rank = np.empty(size, dtype=np.int64)
+        rank[np.random.RandomState(sampling_seed).permutation(size)] = np.arange(size)
+        mask[rows] = rank[positions[rows]] < min(size, sampling_number)
+    return mask
+
+
 def train_test_dataframe(clean_df, random_seed=100):
     
     new_df = clean_df.copy()
@@ -60,8 +67,8 @@ def train_test_dataframe(clean_df, random_seed=100):
     # creating a dictionary of categorical:numerical mappings for plagiarsm categories
     mapping = {0:'orig', 1:'train', 2:'test'} 
 
-    # traversing through dataframe and replacing categorical data
-    new_df.Datatype = [mapping[item] for item in new_df.Datatype] 
+    # replacing categorical data
+    new_df.Datatype = new_df.Datatype.map(mapping)
 
     return new_df
 
@@ -82,31 +89,66 @@ def process_file(file):
     return all_text
 
 
-def create_text_column(df, file_directory='data/'):
+# Runs of characters that process_file turns into spaces and collapses; a lone space is left as
+# it is, so the common case of one space between two words never leaves the regex engine
+_non_alphanumeric = re.compile(r"[^a-z0-9]{2,}|[^a-z0-9 ]")
+
+def _collapsed_spaces(match):
+    # process_file makes every character of the run a space, then replaces pairs of spaces and
+    # then triples of spaces (each left to right, without overlaps) by a single space
+    spaces = (len(match.group()) + 1) // 2
+    return " " * (spaces - 2 * (spaces // 3))
+
+
+def normalize_text(text):
+    '''Single regex pass over a decoded text with the same result as process_file.'''
+    return _non_alphanumeric.sub(_collapsed_spaces, text.lower())
+
+
+def read_text_file(file_path, mmap_threshold=1 << 20):
+    '''Reads a file like open(file_path, 'r', encoding='utf-8', errors='ignore') does, including its
+       newline translation. Files of at least mmap_threshold bytes are memory-mapped instead of
+       being read into a buffer first.'''
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size >= mmap_threshold:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                text = str(mapped, 'utf-8', 'ignore')
+        else:
+            text = str(file.read(), 'utf-8', 'ignore')
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _read_and_normalize(file_path):
+    return normalize_text(read_text_file(file_path)), os.path.getsize(file_path)
+
+
+def create_text_column(df, file_directory='data/', workers=None, verbose=True):
     '''Reads in the files, listed in a df and returns that df with an additional column, `Text`. 
+       Files are read and normalized (with the same result as process_file) in a thread pool.
        :param df: A dataframe of file information including a column for `File`
        :param file_directory: the main directory where files are stored
+       :param workers: number of reading threads (default: a few per core)
+       :param verbose: print the ingestion throughput in files/sec and MB/sec
        :return: A dataframe with processed text '''
    
     # create copy to modify
     text_df = df.copy()
     
-    # store processed text
-    text = []
-    
-    # for each file (row) in the df, read in the file 
-    for row_i in df.index:
-        filename = df.iloc[row_i]['File']
-        #print(filename)
-        file_path = file_directory + filename
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as file:
-
-            # standardize text using helper function
-            file_text = process_file(file)
-            # append processed text to list
-            text.append(file_text)
-    
+    file_paths = [file_directory + filename for filename in df['File']]
+    workers = workers or min(32, (os.cpu_count() or 1) * 4)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(_read_and_normalize, file_paths))
+    elapsed = time.perf_counter() - start
+
     # add column to the copied dataframe
-    text_df['Text'] = text
+    text_df['Text'] = [text for text, _ in results]
+
+    if verbose:
+        megabytes = sum(size for _, size in results) / 1e6
+        print('Read {} files ({:.1f} MB) in {:.2f}s: {:.0f} files/sec, {:.1f} MB/sec'.format(
+            len(file_paths), megabytes, elapsed, len(file_paths) / max(elapsed, 1e-9), megabytes / max(elapsed, 1e-9)))
     
     return text_df
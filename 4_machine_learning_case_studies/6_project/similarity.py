@@ -0,0 +1,237 @@
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer
+
+# Similarity features between student answers and the source text of their task.
+#
+# ContainmentEngine tokenizes every source text once and keeps, for every n, a sparse matrix of
+# n-gram counts with one row per task. The containment of a whole batch of answers is then a
+# single sparse minimum between the answer counts and the source rows of their tasks. Texts are
+# tokenized exactly like CountVectorizer(analyzer='word') does, so the values are the same as
+# fitting a vectorizer on every answer/source pair.
+#
+# LCSEngine computes the normalized longest common subsequence of words with a bit-parallel
+# algorithm: the source words are encoded as integers and every distinct word gets a bit mask of
+# its positions in the source, so one answer word updates the whole LCS row with a few big
+# integer operations instead of a Python loop over every source word.
+#
+# build_features puts both together: it looks up the sources once per task and scores chunks of
+# answers in worker processes, each holding its own engines.
+
+TASKS = ['a', 'b', 'c', 'd', 'e']
+
+
+def read_source_texts(file_directory='data/', tasks=TASKS):
+    """Read the raw source text of every task, keyed by task."""
+    source_texts = {}
+    for task in tasks:
+        path = os.path.join(file_directory, 'orig_task{}.txt'.format(task))
+        with open(path, 'r', encoding='utf-8') as f:
+            source_texts[task] = f.read()
+    return source_texts
+
+
+def _ngrams(tokens, n):
+    """The word n-grams of a token list, joined by spaces like CountVectorizer joins them."""
+    if n == 1:
+        return tokens
+    return [' '.join(tokens[idx:idx + n]) for idx in range(len(tokens) - n + 1)]
+
+
+class ContainmentEngine(object):
+    """
+    N-gram containment of answers in the source text of their task:
+    sum over n-grams of min(answer count, source count) / number of n-grams in the answer.
+    """
+
+    def __init__(self, source_texts):
+        """source_texts maps each task to its raw source text (see read_source_texts)."""
+        vectorizer = CountVectorizer(analyzer='word')
+        self._preprocess = vectorizer.build_preprocessor()
+        self._tokenize = vectorizer.build_tokenizer()
+
+        self.tasks = list(source_texts)
+        self._task_rows = {task: row for row, task in enumerate(self.tasks)}
+        self._source_tokens = [self.tokenize(source_texts[task]) for task in self.tasks]
+        self._indexes = {}
+
+    def tokenize(self, text):
+        """Lower case word tokens of a text, as CountVectorizer(analyzer='word') finds them."""
+        return self._tokenize(self._preprocess(text))
+
+    def _index(self, n):
+        """Vectorizer and (tasks x n-grams) source count matrix for n, built on first use."""
+        if n not in self._indexes:
+            vectorizer = CountVectorizer(analyzer=functools.partial(_ngrams, n=n))
+            source_counts = vectorizer.fit_transform(self._source_tokens).tocsr()
+            self._indexes[n] = vectorizer, source_counts
+        return self._indexes[n]
+
+    def containment_features(self, answer_texts, tasks, ngram_range):
+        """
+        Containment of every answer in the source of its task, for every n in ngram_range.
+        Returns an array of shape (number of answers, number of n values).
+        """
+        answer_tokens = [self.tokenize(text) for text in answer_texts]
+        return self.containment_from_tokens(answer_tokens, tasks, ngram_range)
+
+    def containment_from_tokens(self, answer_tokens, tasks, ngram_range):
+        """Same as containment_features, for answers tokenized with `tokenize` already."""
+        ngram_range = list(ngram_range)
+        rows = np.array([self._task_rows[task] for task in tasks], dtype=np.int64)
+        lengths = np.array([len(tokens) for tokens in answer_tokens], dtype=np.float64)
+
+        features = np.empty((len(answer_tokens), len(ngram_range)))
+        for column, n in enumerate(ngram_range):
+            vectorizer, source_counts = self._index(n)
+            # Answer n-grams that are not in any source do not count towards the intersection,
+            # so the vocabulary of the sources is all we need
+            answer_counts = vectorizer.transform(answer_tokens)
+            common = answer_counts.minimum(source_counts[rows]).sum(axis=1).A1
+            totals = np.maximum(lengths - n + 1, 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                features[:, column] = common / totals
+        return features
+
+    def calculate_containment(self, df, n, answer_filename):
+        """Drop-in replacement for calculate_containment(df, n, answer_filename) of the notebook."""
+        locate_index = np.where(df['File'].values == answer_filename)
+        task = df['Task'].iloc[locate_index].values[0]
+        answer_text = df['Text'].iloc[locate_index].values[0]
+        return float(self.containment_features([answer_text], [task], [n])[0, 0])
+
+
+if hasattr(int, 'bit_count'):
+    def _popcount(value):
+        return value.bit_count()
+else:
+    def _popcount(value):
+        return bin(value).count('1')
+
+
+class LCSEngine(object):
+    """
+    Longest common subsequence of words between many answers and one source text, using the
+    bit-vector algorithm of Hyyro (2004): O(len(answer) * len(source) / 64) time and
+    O(len(source)) memory per answer.
+    """
+
+    def __init__(self, source_text):
+        """source_text is split into words like lcs_norm_word does (lower case, whitespace)."""
+        source_words = source_text.lower().split()
+        self.length = len(source_words)
+        self.word_ids = {}
+        self.masks = []
+        # Bit i of the mask of a word is set if the word is the i-th word of the source
+        for position, word in enumerate(source_words):
+            word_id = self.word_ids.setdefault(word, len(self.word_ids))
+            if word_id == len(self.masks):
+                self.masks.append(0)
+            self.masks[word_id] |= 1 << position
+
+    def encode(self, words):
+        """Integer ids of the words that appear in the source; the others can never match."""
+        word_ids = self.word_ids
+        return [word_ids[word] for word in words if word in word_ids]
+
+    def lcs_length(self, answer_words):
+        """Length of the longest common subsequence of a list of answer words and the source."""
+        all_bits = (1 << self.length) - 1
+        row = all_bits
+        masks = self.masks
+        for word_id in self.encode(answer_words):
+            matches = row & masks[word_id]
+            row = ((row + matches) | (row - matches)) & all_bits
+        # Every zero bit in the row is one word of the common subsequence
+        return self.length - _popcount(row)
+
+    def lcs_norm_word(self, answer_text):
+        """
+        LCS of an answer text and the source, divided by the number of words in the answer
+        (0.0 for an empty answer).
+        """
+        answer_words = answer_text.lower().split()
+        if not answer_words:
+            return 0.0
+        return self.lcs_length(answer_words) / len(answer_words)
+
+    def lcs_norm_batch(self, answer_texts):
+        """lcs_norm_word for every answer text, as an array."""
+        return np.array([self.lcs_norm_word(text) for text in answer_texts], dtype=np.float64)
+
+
+@functools.lru_cache(maxsize=32)
+def _lcs_engine(source_text):
+    return LCSEngine(source_text)
+
+
+def lcs_norm_word(answer_text, source_text):
+    """
+    Normalized LCS of words between an answer and a source text, like lcs_norm_word of the
+    notebook. The bit masks of the most recent source texts are kept for the next call.
+    """
+    return _lcs_engine(source_text).lcs_norm_word(answer_text)
+
+
+_worker_state = {}
+
+
+def _init_worker(source_texts, task_texts, ngram_range):
+    # Only the raw texts travel to the workers (once, as initargs); the n-gram matrices and word
+    # masks are built here, so the chunks carry nothing but answers and tasks
+    _worker_state['containment'] = ContainmentEngine(source_texts)
+    _worker_state['lcs'] = {task: LCSEngine(text) for task, text in task_texts.items()}
+    _worker_state['ngram_range'] = ngram_range
+
+
+def _score_chunk(chunk):
+    """Containment for every n plus the normalized LCS of a chunk of (answer text, task) pairs."""
+    texts, tasks = chunk
+    containment = _worker_state['containment'].containment_features(texts, tasks, _worker_state['ngram_range'])
+    lcs_engines = _worker_state['lcs']
+    lcs = [lcs_engines[task].lcs_norm_word(text) for text, task in zip(texts, tasks)]
+    return np.column_stack([containment, lcs])
+
+
+def build_features(df, ngram_range=range(1, 10), source_texts=None, file_directory='data/',
+                   workers=None, chunk_size=500):
+    """
+    Compute all similarity features of a complete_df in one call: the containment features
+    c_1 .. c_n (against the raw source files, like calculate_containment) and lcs_word (against
+    the Text of the source rows, Class == -1, like create_lcs_features). Source rows get -1 for
+    every feature. Chunks of chunk_size answers are scored in `workers` processes.
+    :return: A features DataFrame with the index of df
+    """
+    ngram_range = list(ngram_range)
+    workers = os.cpu_count() if workers is None else workers
+    if source_texts is None:
+        source_texts = read_source_texts(file_directory, sorted(df['Task'].unique()))
+
+    # One lookup of every task's source row, instead of filtering the frame for every answer
+    originals = df[df['Class'] == -1]
+    task_texts = dict(zip(originals['Task'], originals['Text']))
+
+    is_answer = (df['Category'] > -1).values
+    texts = df['Text'].values[is_answer].tolist()
+    tasks = df['Task'].values[is_answer].tolist()
+    chunks = [(texts[idx:idx + chunk_size], tasks[idx:idx + chunk_size]) for idx in range(0, len(texts), chunk_size)]
+
+    initargs = (source_texts, task_texts, ngram_range)
+    if workers <= 1 or len(chunks) <= 1:
+        _init_worker(*initargs)
+        results = list(map(_score_chunk, chunks))
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as executor:
+            results = list(executor.map(_score_chunk, chunks))
+
+    columns = ['c_' + str(n) for n in ngram_range] + ['lcs_word']
+    features = np.full((len(df), len(columns)), -1.0)
+    if results:
+        features[is_answer] = np.vstack(results)
+
+    print('{} features created for {} answers!'.format(len(columns), len(texts)))
+    return pd.DataFrame(features, columns=columns, index=df.index)